@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+
+"""
+benchmark.py - Times loading, saving and converting a fixed set of designs.
+
+Copyright (C) 2026 agent <agent@local>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json, os, platform, random, shutil, subprocess, sys, tempfile, time
+import traceback
+from array import array
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import jef
+
+# The designs in the corpus: (name, stitches, threads, seed).
+corpus = [("small", 2000, 4, 1),
+          ("medium", 100000, 12, 2),
+          ("huge", 1000000, 40, 3)]
+
+stages = ["load", "save", "jef2png", "jef2svg", "svg2jef"]
+
+# Stitches are kept within this distance of the origin, in tenths of a
+# millimetre, so that the designs fit in a large hoop.
+limit = 900
+
+
+def _bounce(value):
+
+    if value > limit:
+        return 2 * limit - value
+    elif value < -limit:
+        return -2 * limit - value
+    else:
+        return value
+
+
+def make_pattern(stitches, threads, seed):
+
+    """Returns a Pattern containing the given number of stitches in random
+    walks, divided equally between the given number of threads, with about
+    one jump in every hundred stitches. The same seed always produces the
+    same pattern."""
+    
+    generator = random.Random(seed)
+    xs, ys, commands = array("i"), array("i"), array("B")
+    offsets = array("I", [0])
+    x, y = 0, 0
+    
+    for thread in range(threads):
+    
+        for i in xrange(stitches // threads):
+        
+            if i == 0 or generator.random() < 0.01:
+                command, step = jef.MOVE, 120
+            else:
+                command, step = jef.STITCH, 40
+            
+            x = _bounce(x + generator.randint(-step, step))
+            y = _bounce(y + generator.randint(-step, step))
+            xs.append(x)
+            ys.append(y)
+            commands.append(command)
+        
+        offsets.append(len(commands))
+    
+    pattern = jef.Pattern()
+    pattern.coordinates = jef.Stitches(xs, ys, commands, offsets)
+    pattern.colours = [generator.randint(1, 70) for i in range(threads)]
+    pattern.thread_types = [13] * threads
+    pattern.date_time = time.gmtime(0)
+    return pattern
+
+
+def write_corpus(directory, designs):
+
+    for name, stitches, threads, seed in designs:
+        make_pattern(stitches, threads, seed).save(os.path.join(directory, name + ".jef"))
+
+
+def _measure(function, *args):
+
+    """Calls function(*args) in a child process, returning the time it took
+    in seconds and the peak resident memory of the child in kilobytes, or
+    raising RuntimeError if it failed. If the function returns a number, that
+    is used as the time taken instead, so that preparation can be left out."""
+    
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            start = time.time()
+            elapsed = function(*args)
+            if elapsed is None:
+                elapsed = time.time() - start
+            os.write(write_fd, repr(elapsed))
+        except:
+            traceback.print_exc()
+            status = 1
+        os._exit(status)
+    
+    os.close(write_fd)
+    f = os.fdopen(read_fd, "rb")
+    output = f.read()
+    f.close()
+    
+    pid, status, usage = os.wait4(pid, 0)
+    if status != 0:
+        raise RuntimeError("%s failed" % function.__name__.strip("_"))
+    
+    return float(output), usage.ru_maxrss
+
+
+def _measure_command(arguments):
+
+    """Runs the command with the given arguments in the directory containing
+    the converters, returning the time it took in seconds and its peak
+    resident memory in kilobytes, or raising RuntimeError if it failed."""
+    
+    null = open(os.devnull, "w")
+    start = time.time()
+    process = subprocess.Popen(arguments, cwd = root, stdout = null)
+    pid, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    null.close()
+    
+    # The process has been waited for, so record its status for Popen.
+    process.returncode = status
+    if status != 0:
+        raise RuntimeError("%s failed" % arguments[1])
+    
+    return elapsed, usage.ru_maxrss
+
+
+def _load(path):
+
+    jef.Pattern(path)
+
+
+def _save(path, output):
+
+    pattern = jef.Pattern(path)
+    
+    # Make the pattern encode every thread instead of copying the threads
+    # from the file it was loaded from.
+    for i in range(len(pattern.coordinates)):
+        pattern.coordinates.mark_modified(i)
+    
+    start = time.time()
+    if not pattern.save(output):
+        raise IOError("Failed to save %s" % output)
+    
+    return time.time() - start
+
+
+def have_converters():
+
+    """Returns True if the converters can be run, which requires PyQt4."""
+    
+    null = open(os.devnull, "w")
+    try:
+        return subprocess.call([sys.executable, "-c", "import PyQt4.QtSvg"],
+                               stderr = null) == 0
+    finally:
+        null.close()
+
+
+def run_stage(stage, path, directory):
+
+    """Runs the given stage for the design in the file with the given path,
+    writing any output files to directory, and returns the time taken in
+    seconds and the peak memory used in kilobytes. The svg2jef stage reads
+    the file written by the jef2svg stage."""
+    
+    name = os.path.splitext(os.path.basename(path))[0]
+    output = os.path.join(directory, name + "-" + stage)
+    svg_file = os.path.join(directory, name + ".svg")
+    
+    if stage == "load":
+        return _measure(_load, path)
+    elif stage == "save":
+        return _measure(_save, path, output + ".jef")
+    elif stage == "jef2png":
+        return _measure_command([sys.executable, "jef2png.py", "--stitches-only",
+                                 "256x256", path, output + ".png"])
+    elif stage == "jef2svg":
+        return _measure_command([sys.executable, "jef2svg.py", "--stitches-only",
+                                 path, svg_file])
+    elif stage == "svg2jef":
+        return _measure_command([sys.executable, "svg2jef.py", svg_file,
+                                 output + ".jef"])
+    else:
+        raise ValueError("Unknown stage: %s" % stage)
+
+
+def run(sizes = None, repeat = 3):
+
+    """Writes the designs with the given names in the corpus (or all of them)
+    to a temporary directory and runs each stage on them, returning a
+    dictionary describing the results that can be written as JSON.
+    
+    Each stage is run the given number of times in a separate process; the
+    shortest time and the largest peak memory are recorded. Stages that
+    cannot be run are given a reason instead."""
+    
+    designs = [design for design in corpus if sizes is None or design[0] in sizes]
+    directory = tempfile.mkdtemp()
+    converters = have_converters()
+    results = {}
+    
+    try:
+        # Make the designs in a child process so that the memory used does
+        # not count towards the stages, which are forked from this process.
+        _measure(write_corpus, directory, designs)
+        
+        for name, stitches, threads, seed in designs:
+        
+            path = os.path.join(directory, name + ".jef")
+            
+            for stage in stages:
+            
+                key = "%s/%s" % (stage, name)
+                if stage not in ("load", "save") and not converters:
+                    results[key] = {"skipped": "PyQt4 is not available"}
+                    continue
+                
+                try:
+                    times, peaks = zip(*[run_stage(stage, path, directory)
+                                         for i in range(repeat)])
+                except RuntimeError, e:
+                    results[key] = {"error": str(e)}
+                    continue
+                
+                seconds = min(times)
+                results[key] = {"seconds": seconds,
+                                "stitches": stitches,
+                                "stitches_per_second": stitches / max(seconds, 1e-9),
+                                "peak_memory_kb": max(peaks)}
+    
+    finally:
+        shutil.rmtree(directory)
+    
+    numpy = jef.numpy and jef.numpy.__version__
+    return {"environment": {"python": platform.python_version(),
+                            "platform": platform.platform(),
+                            "numpy": numpy or None,
+                            "repeat": repeat,
+                            "corpus": designs},
+            "results": results}
+
+
+def compare(report, baseline, time_threshold = 0.2, memory_threshold = 0.2):
+
+    """Returns a list of messages describing the results in the report that
+    are slower or use more memory than those in the baseline report by more
+    than the given fractions. Stages that failed are also reported."""
+    
+    messages = []
+    old_results = baseline["results"]
+    
+    for key, result in sorted(report["results"].items()):
+    
+        old = old_results.get(key)
+        if "error" in result:
+            messages.append("%s: %s" % (key, result["error"]))
+        if not old or "seconds" not in old or "seconds" not in result:
+            continue
+        
+        if result["seconds"] > old["seconds"] * (1 + time_threshold):
+            messages.append("%s: %.3f s, was %.3f s" % (key, result["seconds"], old["seconds"]))
+        
+        if result["peak_memory_kb"] > old["peak_memory_kb"] * (1 + memory_threshold):
+            messages.append("%s: %i KB, was %i KB" % (key, result["peak_memory_kb"],
+                                                      old["peak_memory_kb"]))
+    
+    return messages
+
+
+def read_argument(name, args):
+
+    matching = filter(lambda x: x.startswith(name), args)
+    value = False
+    
+    for item in matching:
+        args.remove(item)
+        if name.endswith("="):
+            value = item[len(name):]
+        else:
+            value = True
+    
+    return value
+
+
+if __name__ == "__main__":
+
+    output = read_argument("--output=", sys.argv)
+    baseline = read_argument("--baseline=", sys.argv)
+    sizes = read_argument("--sizes=", sys.argv)
+    repeat = read_argument("--repeat=", sys.argv) or "3"
+    time_threshold = read_argument("--time-threshold=", sys.argv) or "0.2"
+    memory_threshold = read_argument("--memory-threshold=", sys.argv) or "0.2"
+    
+    if len(sys.argv) != 1:
+        sys.stderr.write("Usage: %s [--sizes=small,medium,huge] [--repeat=<n>] [--output=<JSON file>]\n"
+                         "       [--baseline=<JSON file>] [--time-threshold=<fraction>] [--memory-threshold=<fraction>]\n"
+                         % sys.argv[0])
+        sys.exit(1)
+    
+    try:
+        repeat = int(repeat)
+        time_threshold = float(time_threshold)
+        memory_threshold = float(memory_threshold)
+        if repeat < 1:
+            raise ValueError
+    except ValueError:
+        sys.stderr.write("Please specify a positive number of repeats and thresholds as fractions.\n"
+                         "For example: --repeat=3 --time-threshold=0.2\n")
+        sys.exit(1)
+    
+    if sizes:
+        sizes = sizes.split(",")
+        unknown = set(sizes) - set(name for name, stitches, threads, seed in corpus)
+        if unknown:
+            sys.stderr.write("Unknown sizes: %s\n" % ", ".join(sorted(unknown)))
+            sys.exit(1)
+    
+    report = run(sizes or None, repeat)
+    
+    for key, result in sorted(report["results"].items()):
+        if "seconds" in result:
+            print "%-16s %9.3f s %12i stitches/s %9i KB" % (
+                key, result["seconds"], result["stitches_per_second"],
+                result["peak_memory_kb"])
+        else:
+            print "%-16s %s" % (key, result.get("skipped") or result.get("error"))
+    
+    if output:
+        f = open(output, "w")
+        json.dump(report, f, indent = 2, sort_keys = True)
+        f.close()
+    
+    if baseline:
+        f = open(baseline)
+        messages = compare(report, json.load(f), time_threshold, memory_threshold)
+        f.close()
+        
+        for message in messages:
+            sys.stderr.write(message + "\n")
+        
+        if messages:
+            sys.exit(1)
+    
+    sys.exit()
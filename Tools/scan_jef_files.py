@@ -24,7 +24,7 @@ if __name__ == "__main__":
     
     for path in paths:
     
-        j = jef.Pattern(path)
+        j = jef.peek(path)
         for i in range(len(j.colours)):
             if not jef.jef_colours.colours.has_key(j.colours[i]):
                 if jef.jef_colours.measured_colours.colours.has_key(j.colours[i]):
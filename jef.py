@@ -19,16 +19,2201 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import struct, sys, time
+import bisect, hashlib, math, mmap, multiprocessing, operator, os, shutil
+import struct, sys, tempfile, time, traceback
+from array import array
+from collections import deque, namedtuple
+from itertools import imap, islice, izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from Colours import jef_colours
 
-class Pattern:
+_header_start = struct.Struct("<II")
+_header_counts = struct.Struct("<III")
+_rectangle = struct.Struct("<iiii")
+
+# Commands recorded for each decoded coordinate.
+STITCH = 0
+MOVE = 1
+
+command_names = ("stitch", "move")
+command_codes = {"stitch": STITCH, "move": MOVE}
+
+# Hoop names and sizes in millimetres for each hoop code.
+hoops = {
+    0: ("A", (126, 110)),
+    1: ("C", (50, 50)),
+    2: ("B", (140, 200)),
+    3: ("F", (126, 110)),
+    4: ("D", (230, 200)),
+    }
+
+hoop_codes = dict((name, code) for code, (name, size) in hoops.items())
+
+Header = namedtuple("Header", "start date_time threads data_length hoop_code "
+                              "hoop_name hoop_size rectangles colours thread_types")
+
+# The encoded form of a thread: the data it was read from or written to, the
+# indices of its first byte, the byte after its first coordinate pair and the
+# byte after its last one, and the position it starts from.
+Block = namedtuple("Block", "data start first_end end x y")
+
+# Statistics for a thread and for a whole pattern. Lengths are in millimetres
+# and jumps are the runs of moves that follow stitches within a thread.
+ThreadStats = namedtuple("ThreadStats", "stitches jumps length longest")
+PatternStats = namedtuple("PatternStats", "threads stitches jumps colour_changes "
+                                          "length longest")
+
+
+def _check_threads(d):
+
+    """Returns the length of the colour tables in the JEF file whose contents
+    begin with the string or buffer d, which must hold at least the first 28
+    bytes of the file, raising ValueError if the thread count in the header
+    does not leave room for them before the stitch data."""
+    
+    start = struct.unpack_from("<I", d, 0)[0]
+    threads = struct.unpack_from("<I", d, 24)[0]
+    if start < 0x74 + 8 * threads:
+        raise ValueError("Invalid thread count %i for stitch data at offset %i."
+                         % (threads, start))
+    
+    return 8 * threads
+
+
+def read_header(d):
+
+    """Returns a Header describing the JEF file whose contents begin with the
+    string or buffer d, which must hold at least the first 0x74 + 8 * threads
+    bytes of the file."""
+    
+    _check_threads(d)
+    start, flags = struct.unpack_from("<II", d, 0)
+    
+    date_time = None
+    if flags & 1:
+        date_time = time.strptime(d[8:22], "%Y%m%d%H%M%S")
+    
+    threads, data_length, hoop_code = struct.unpack_from("<III", d, 24)
+    
+    # start + data_length * 2 should equal the file length.
+    
+    hoop_name, hoop_size = hoops.get(hoop_code, (None, None))
+    
+    # These are coordinates specifying rectangles for the pattern.
+    # It appears that the units are 0.2 mm.
+    rectangles = []
+    values = struct.unpack_from("<20i", d, 0x24)
+    for i in range(0, 20, 4):
+        x1, y1, x2, y2 = values[i:i+4]
+        if x1 != -1 and y1 != -1 and x2 != -1 and y2 != -1:
+            rectangles.append((-x1, -y1, x2, y2))
+    
+    # If the hoop code is even, the 4 byte words from 68 to 74 should all be
+    # -1.
+    
+    # The colour table always seems to start at offset 0x74 and is followed
+    # by the thread type table.
+    colours = struct.unpack_from("<%ii" % threads, d, 0x74)
+    thread_types = struct.unpack_from("<%ii" % threads, d, 0x74 + (4 * threads))
+    
+    return Header(start, date_time, threads, data_length * 2, hoop_code,
+                  hoop_name, hoop_size, tuple(rectangles), colours, thread_types)
+
+
+def peek(path):
+
+    """Returns a Header describing the JEF file with the given path, reading
+    only the fixed header and the colour tables from the file."""
+    
+    f = open(path, "rb")
+    try:
+        d = f.read(0x74)
+        if len(d) >= 28:
+            d += f.read(_check_threads(d))
+    finally:
+        f.close()
+    
+    return read_header(d)
+
+
+def _accumulate(deltas, x = 0, y = 0):
+
+    """Returns arrays of the x and y coordinates reached by applying the pairs
+    of signed byte deltas in the deltas string, in turn, to (x, y)."""
+    
+    if numpy and deltas:
+        values = numpy.frombuffer(deltas, numpy.int8).reshape(-1, 2)
+        totals = numpy.cumsum(values, axis = 0, dtype = numpy.int32)
+        totals += (x, y)
+        return array("i", totals[:,0].tostring()), array("i", totals[:,1].tostring())
+    
+    values = array("b", deltas).tolist()
+    if values:
+        values[0] += x
+        values[1] += y
+    
+    for i in xrange(2, len(values)):
+        values[i] += values[i-2]
+    
+    xs, ys = array("i"), array("i")
+    xs.fromlist(values[0::2])
+    ys.fromlist(values[1::2])
+    return xs, ys
+
+
+class Decoder:
+
+    """Decoder
+    
+    Decodes stitch data supplied in one or more consecutive pieces, keeping
+    the current position, the number of coordinates read for the current
+    thread and whether the next stitch starts a thread or follows a move.
+    
+    For each thread that is ended, the blocks list receives a tuple holding
+    the indices in the data of the thread's first byte, the byte after the
+    first coordinate pair and the byte after its last coordinate pair. These
+    are only meaningful when the data is decoded in one piece.
+    """
+    
+    def __init__(self):
+    
+        self.x, self.y = 0, 0
+        self.first = True
+        self.length = 0
+        self.finished = False
+        self.blocks = []
+        self._block = None
+    
+    def decode(self, data, start = 0, end = None, final = True):
+    
+        """Decodes the stitch data held in data[start:end], which must begin
+        with a control code or coordinate pair.
+        
+        Returns arrays of x coordinates, y coordinates and commands, a list
+        of the indices in those arrays at which threads end, and the index in
+        data where decoding stopped. Unless final is True, decoding stops
+        before a control code that is incomplete.
+        
+        Control codes are found by searching for 0x80 bytes at the start of
+        each coordinate pair. The deltas between them are collected without
+        being unpacked and converted to coordinates in a single pass at the
+        end.
+        """
+        
+        if end is None:
+            end = len(data)
+        
+        pieces = []
+        commands = array("B")
+        ends = []
+        first = self.first
+        length = self.length
+        block = self._block
+        i = start
+        
+        while i < end:
+        
+            # Find the next control code, ignoring 0x80 bytes that are the
+            # second value in a coordinate pair.
+            j = data.find("\x80", i, end)
+            while j != -1 and (j - start) % 2:
+                j = data.find("\x80", j + 1, end)
+            
+            if j == -1:
+                j = end - (end - i) % 2
+            
+            if j > i:
+                if not length:
+                    block = (i, i + 2)
+                pieces.append(data[i:j])
+                run = array("B", [STITCH]) * ((j - i) / 2)
+                if first:
+                    # The first stitch in a thread is a move to its position.
+                    run[0] = MOVE
+                    first = False
+                commands.extend(run)
+                length += len(run)
+                i = j
+            
+            if i + 1 >= end:
+                break
+            
+            token = i
+            code = data[i+1]
+            if i + 4 > end and (code == "\x02" or code == "\x01" and not final):
+                # Wait for the rest of the control code and its values.
+                break
+            
+            if code == "\x01":
+                # Starting a new thread. Record the end of the current thread,
+                # if it contains any coordinates, and skip the next two bytes.
+                if length:
+                    ends.append(len(commands))
+                    self.blocks.append(block + (i,))
+                    length = 0
+                first = True
+                i += 4
+                continue
+            elif code == "\x02":
+                # Move command.
+                i += 2
+                command = MOVE
+                first = True
+            elif code == "\x10":
+                # End of data.
+                if length:
+                    ends.append(len(commands))
+                    self.blocks.append(block + (i,))
+                    length = 0
+                self.finished = True
+                i += 2
+                break
+            elif first:
+                command = MOVE
+                first = False
+            else:
+                command = STITCH
+            
+            if not length:
+                block = (token, i + 2)
+            pieces.append(data[i:i+2])
+            commands.append(command)
+            length += 1
+            i += 2
+        
+        xs, ys = _accumulate("".join(pieces), self.x, self.y)
+        if commands:
+            self.x, self.y = xs[-1], ys[-1]
+        
+        self.first = first
+        self.length = length
+        self._block = block
+        return xs, ys, commands, ends, i
+
+
+def decode_stitches(data, start = 0, end = None, blocks = None):
+
+    """Decodes the stitch data held in data[start:end].
+    
+    Returns arrays of x coordinates, y coordinates and commands, and an array
+    of offsets into them at which each thread starts, ending with the total
+    number of coordinates. If a blocks list is given, it is extended with the
+    Decoder's tuples describing where each thread is found in the data.
+    """
+    
+    decoder = Decoder()
+    xs, ys, commands, ends, i = decoder.decode(data, start, end)
+    if blocks is not None:
+        blocks.extend(decoder.blocks)
+    
+    offsets = array("I", [0])
+    offsets.extend(array("I", ends))
+    
+    # Discard any coordinates from a thread that was not terminated.
+    del xs[offsets[-1]:]
+    del ys[offsets[-1]:]
+    del commands[offsets[-1]:]
+    
+    return xs, ys, commands, offsets
+
+
+def _sum_deltas(data, pieces, x, y):
+
+    """Returns the position reached by applying all the pairs of deltas found
+    in the given (start, end) ranges of data to (x, y)."""
+    
+    deltas = "".join([data[i:j] for i, j in pieces])
+    
+    if numpy and deltas:
+        dx, dy = numpy.frombuffer(deltas, numpy.int8).reshape(-1, 2).sum(axis = 0)
+        return x + int(dx), y + int(dy)
+    
+    values = array("b", deltas)
+    return x + sum(values[0::2]), y + sum(values[1::2])
+
+
+def scan_blocks(data, start = 0, end = None):
+
+    """Returns a list containing a Block for each thread in the stitch data
+    held in data[start:end], as recorded by Stitches.decode().
+    
+    Only the control codes are examined and the deltas between them are
+    summed to find the position each thread starts from, so that individual
+    threads can later be decoded with decode_block() without decoding the
+    others.
+    """
+    
+    if end is None:
+        end = len(data)
+    
+    blocks = []
+    pieces = []
+    block = None
+    x, y = 0, 0
+    i = start
+    
+    while i < end:
+    
+        j = data.find("\x80", i, end)
+        while j != -1 and (j - start) % 2:
+            j = data.find("\x80", j + 1, end)
+        
+        if j == -1:
+            j = end - (end - i) % 2
+        
+        if j > i:
+            if block is None:
+                block = (i, i + 2)
+            pieces.append((i, j))
+            i = j
+        
+        if i + 1 >= end:
+            break
+        
+        token = i
+        code = data[i+1]
+        
+        if code == "\x01" or code == "\x10":
+            # Record the thread that ends here, if it contains any coordinates.
+            if block is not None:
+                blocks.append(Block(data, block[0], block[1], i, x, y))
+                x, y = _sum_deltas(data, pieces, x, y)
+                pieces = []
+                block = None
+            if code == "\x10":
+                break
+            i += 4
+            continue
+        elif code == "\x02":
+            i += 2
+        
+        if block is None:
+            block = (token, i + 2)
+        pieces.append((i, i + 2))
+        i += 2
+    
+    return blocks
+
+
+def decode_block(block):
+
+    """Decodes the stitch data of the thread described by the given Block,
+    returning arrays of x coordinates, y coordinates and commands."""
+    
+    decoder = Decoder()
+    decoder.x, decoder.y = block.x, block.y
+    xs, ys, commands, ends, i = decoder.decode(block.data, block.start, block.end)
+    return xs, ys, commands
+
+
+def _control_pairs(data, start, end):
+
+    """Returns a list of the indices of the complete pairs of bytes in
+    data[start:end] that begin with 0x80, counting pairs from start. These
+    are the control codes, along with any values following them that begin
+    with the same byte."""
+    
+    n = (end - start) / 2
+    
+    if numpy:
+        if not n:
+            return []
+        values = numpy.frombuffer(data, numpy.uint8, 2 * n, start)
+        return numpy.flatnonzero(values[0::2] == 0x80).tolist()
+    
+    pairs = []
+    i = data.find("\x80", start, start + 2 * n)
+    while i != -1:
+        if (i - start) % 2 == 0:
+            pairs.append((i - start) / 2)
+        i = data.find("\x80", i + 1, start + 2 * n)
+    
+    return pairs
+
+
+def _positions(data, start, stop, skipped, indices):
+
+    """Returns arrays of the x and y coordinates reached, starting from
+    (0, 0), after applying the pairs of signed byte deltas in data from start
+    up to the pair with index stop, leaving out the pairs with indices in the
+    skipped list, up to and including each of the applied pairs with the
+    given indices."""
+    
+    if numpy:
+        if not len(indices):
+            return array("i"), array("i")
+        
+        # Find the pair holding each coordinate, then sum the deltas between
+        # them with the skipped pairs set to zero.
+        skipped = numpy.array(skipped, numpy.int64)
+        indices = numpy.array(indices, numpy.int64)
+        before = skipped - numpy.arange(len(skipped))
+        pairs = indices + numpy.searchsorted(before, indices, "right")
+        
+        values = numpy.frombuffer(data, numpy.int8, 2 * stop, start).reshape(-1, 2)
+        values = values[:pairs[-1] + 1].copy()
+        values[skipped] = 0
+        bounds = numpy.concatenate(([0], pairs[:-1] + 1))
+        positions = numpy.add.reduceat(values, bounds, axis = 0, dtype = numpy.int32)
+        positions = positions.cumsum(axis = 0, dtype = numpy.int32)
+        return (array("i", positions[:, 0].tostring()),
+                array("i", positions[:, 1].tostring()))
+    
+    pieces = []
+    i = 0
+    for j in skipped + [stop]:
+        pieces.append(data[start + 2*i:start + 2*j])
+        i = j + 1
+    
+    values = array("b", "".join(pieces))
+    dxs, dys = values[0::2], values[1::2]
+    xs, ys = array("i"), array("i")
+    x = y = previous = 0
+    for i in indices:
+        x += sum(dxs[previous:i + 1])
+        y += sum(dys[previous:i + 1])
+        xs.append(x)
+        ys.append(y)
+        previous = i + 1
+    
+    return xs, ys
+
+
+def sample_stitches(data, start = 0, end = None, budget = None):
+
+    """Decodes at most budget coordinates, spread over the stitch data held
+    in data[start:end], returning arrays like those of decode_stitches()
+    followed by the number of coordinates that a full decode would return.
+    
+    The first and last coordinates of each thread are always kept, and the
+    rest of the budget is spent on stitches taken at even intervals, each
+    kept with the coordinate before it so that it is drawn as it appears in
+    the design. A coordinate that does not follow the one before it in the
+    design is made a move, so that no line is drawn across the stitches that
+    were left out. If budget is None or the data holds no more coordinates
+    than that, the result is the same as that of decode_stitches().
+    
+    Only the control codes are examined one at a time; with NumPy they are
+    found by comparing the first byte of every pair with 0x80 at once, and
+    the deltas are summed between the coordinates that are kept, so that
+    only those coordinates are created.
+    """
+    
+    if end is None:
+        end = len(data)
+    
+    skipped = []    # indices of the pairs that do not hold coordinates
+    moves = []      # indices of the coordinates that are moves
+    ends = []       # index after the last coordinate of each thread
+    stop = 0        # index of the pair after the last complete thread
+    count = 0       # number of coordinates before the pair with index i
+    first = True
+    i = 0
+    
+    for j in _control_pairs(data, start, end):
+    
+        if j < i:
+            # The values of a colour change or move.
+            continue
+        
+        if j > i:
+            if first:
+                # The first stitch in a thread is a move to its position.
+                moves.append(count)
+                first = False
+            count += j - i
+            i = j
+        
+        code = data[start + 2*j + 1]
+        if code == "\x01" or code == "\x10":
+            # Record the end of the current thread if it contains any
+            # coordinates.
+            if count > (ends and ends[-1] or 0):
+                ends.append(count)
+                stop = j
+            if code == "\x10":
+                break
+            skipped.extend((j, j + 1))
+            first = True
+            i = j + 2
+            continue
+        elif code == "\x02":
+            skipped.append(j)
+            moves.append(count)
+            first = True
+            i = j + 1
+        elif first:
+            moves.append(count)
+            first = False
+        
+        count += 1
+        i += 1
+    
+    # Discard any coordinates from a thread that was not terminated.
+    total = ends and ends[-1] or 0
+    skipped = [j for j in skipped if j < stop]
+    moves = moves[:bisect.bisect_left(moves, total)]
+    
+    if budget is None or total <= budget:
+        indices = range(total)
+    else:
+        starts = [0] + ends[:-1]
+        kept = set(starts) | set(k - 1 for k in ends)
+        segments = (budget - len(kept)) / 2
+        stitches = total - len(moves)
+        
+        if segments > 0 and stitches:
+            # Find the index of every step'th stitch by counting the moves
+            # before it.
+            step = -(-stitches // segments)
+            p = 0
+            for rank in xrange(step / 2, stitches, step):
+                while p < len(moves) and moves[p] <= rank + p:
+                    p += 1
+                kept.update((rank + p - 1, rank + p))
+        
+        indices = sorted(kept)
+    
+    move_set = set(moves)
+    commands = array("B")
+    previous = -2
+    for k in indices:
+        if k == previous + 1 and k not in move_set:
+            commands.append(STITCH)
+        else:
+            commands.append(MOVE)
+        previous = k
+    
+    offsets = array("I", [0])
+    offsets.extend([bisect.bisect_left(indices, k) for k in ends])
+    
+    xs, ys = _positions(data, start, stop, skipped, indices)
+    return xs, ys, commands, offsets, total
+
+
+class StitchReader:
+
+    """StitchReader
+    
+    Reads the header of a JEF file from a file object, making it available
+    as the header attribute, and provides generators that read and decode
+    the stitch data a block at a time. The file is only read forwards, so
+    pipes and other streams that cannot seek can be used.
+    
+    Unlike Pattern, the stitches of a final thread that is not terminated
+    by an end of data code are returned, since they are read before the
+    end of the file is reached.
+    """
+    
+    def __init__(self, f, block_size = 65536):
+    
+        self.file = f
+        self.block_size = block_size
+        
+        d = f.read(0x74)
+        if len(d) >= 28:
+            d += f.read(_check_threads(d))
+        
+        self.header = read_header(d)
+        
+        # Skip any data between the colour tables and the stitch data.
+        if self.header.start > len(d):
+            f.read(self.header.start - len(d))
+        
+        self._pending = d[self.header.start:]
+    
+    def chunks(self, size = 4096):
+    
+        """Yields (thread, x, y, commands) tuples, where x, y and commands are
+        arrays holding up to the given number of consecutive stitches from
+        the thread with the given index."""
+        
+        decoder = Decoder()
+        thread = 0
+        data = self._pending
+        self._pending = ""
+        
+        while not decoder.finished:
+        
+            block = self.file.read(self.block_size)
+            data += block
+            xs, ys, commands, ends, i = decoder.decode(data, final = not block)
+            data = data[i:]
+            
+            start = 0
+            for n, end in enumerate(ends + [len(commands)]):
+            
+                for j in xrange(start, end, size):
+                    k = min(j + size, end)
+                    yield thread + n, xs[j:k], ys[j:k], commands[j:k]
+                
+                start = end
+            
+            thread += len(ends)
+            
+            if not block:
+                break
+    
+    def stitches(self):
+    
+        """Yields a (thread, command, x, y) tuple for each stitch."""
+        
+        for thread, xs, ys, commands in self.chunks():
+            for command, x, y in izip(commands, xs, ys):
+                yield thread, command, x, y
+
+
+def _differences(values, previous):
+
+    """Returns the difference between each value in the values array and the
+    one before it, using the previous value given for the first one, as a
+    NumPy array if NumPy is available or a list otherwise."""
+    
+    if numpy:
+        values = numpy.frombuffer(values, numpy.int32)
+        differences = numpy.empty(len(values), numpy.int32)
+        differences[0] = values[0] - previous
+        numpy.subtract(values[1:], values[:-1], differences[1:])
+        return differences
+    
+    previous = array("i", [previous])
+    previous.extend(values[:-1])
+    return map(operator.sub, values, previous)
+
+
+def _split(xs, ys, commands, dxs, dys, x, y, limit):
+
+    """Returns new arrays of coordinates and commands in which each move or
+    stitch from the previous coordinates (or x, y) that is longer than limit
+    in either direction is replaced by the smallest number of equal moves or
+    stitches that are within the limit."""
+    
+    if numpy:
+        steps = numpy.maximum(numpy.abs(dxs), numpy.abs(dys))
+        steps = numpy.maximum((steps + limit - 1) // limit, 1)
+        
+        # For each new coordinate, find the index of the coordinate it is
+        # derived from and how many steps along the original line it is.
+        index = numpy.repeat(numpy.arange(len(steps)), steps)
+        step = numpy.arange(len(index)) - numpy.repeat(numpy.cumsum(steps) - steps, steps) + 1
+        
+        steps = steps[index]
+        new_xs = numpy.frombuffer(xs, numpy.int32)[index] - dxs[index]
+        new_xs += (dxs[index] * step) // steps
+        new_ys = numpy.frombuffer(ys, numpy.int32)[index] - dys[index]
+        new_ys += (dys[index] * step) // steps
+        new_commands = numpy.frombuffer(commands, numpy.uint8)[index]
+        
+        return (array("i", new_xs.astype(numpy.int32).tostring()),
+                array("i", new_ys.astype(numpy.int32).tostring()),
+                array("B", new_commands.tostring()))
+    
+    new_xs, new_ys, new_commands = array("i"), array("i"), array("B")
+    
+    for command, nx, ny, dx, dy in izip(commands, xs, ys, dxs, dys):
+    
+        steps = -(-max(abs(dx), abs(dy)) // limit)
+        for step in xrange(1, steps):
+            new_xs.append(x + (dx * step) // steps)
+            new_ys.append(y + (dy * step) // steps)
+            new_commands.append(command)
+        
+        new_xs.append(nx)
+        new_ys.append(ny)
+        new_commands.append(command)
+        x, y = nx, ny
+    
+    return new_xs, new_ys, new_commands
+
+
+def _bytes(differences):
+
+    """Returns an array of signed bytes containing the given differences."""
+    
+    if numpy:
+        return array("b", differences.astype(numpy.int8).tostring())
+    else:
+        return array("b", differences)
+
+
+def _largest(dxs, dys):
+
+    """Returns the largest magnitude of the differences in dxs and dys."""
+    
+    if numpy:
+        return max(-dxs.min(), dxs.max(), -dys.min(), dys.max())
+    else:
+        return max(-min(dxs), max(dxs), -min(dys), max(dys))
+
+
+def _pack_coordinates(xs, ys):
+
+    """Returns the coordinates in the xs and ys arrays as a string of pairs
+    of signed byte deltas if each point is close enough to the one before
+    it, or as a tuple of strings containing the arrays otherwise."""
+    
+    if xs:
+        dxs, dys = _differences(xs, 0), _differences(ys, 0)
+        if _largest(dxs, dys) <= 127:
+            deltas = array("b", [0]) * (2 * len(xs))
+            deltas[0::2] = _bytes(dxs)
+            deltas[1::2] = _bytes(dys)
+            return deltas.tostring()
+    
+    return xs.tostring(), ys.tostring()
+
+
+def _unpack_coordinates(value):
+
+    """Returns arrays of x and y coordinates from a value returned by
+    _pack_coordinates()."""
+    
+    if isinstance(value, tuple):
+        return array("i", value[0]), array("i", value[1])
+    
+    return _accumulate(value)
+
+
+def _encode_thread(out, xs, ys, commands, x, y, limit = 127):
+
+    """Appends the stitch data for the thread with the coordinates and
+    commands in the given arrays to the bytearray out, starting from the
+    position (x, y). Moves and stitches that are longer than limit in either
+    direction are split into shorter ones."""
+    
+    dxs = _differences(xs, x)
+    dys = _differences(ys, y)
+    
+    if _largest(dxs, dys) > limit:
+        xs, ys, commands = _split(xs, ys, commands, dxs, dys, x, y, limit)
+        dxs = _differences(xs, x)
+        dys = _differences(ys, y)
+    
+    deltas = array("b", [0]) * (2 * len(xs))
+    deltas[0::2] = _bytes(dxs)
+    deltas[1::2] = _bytes(dys)
+    deltas = deltas.tostring()
+    
+    # Insert a move code before each pair of values for a move, finding
+    # moves by searching the commands as a string.
+    codes = commands.tostring()
+    move = chr(MOVE)
+    i = 0
+    j = codes.find(move)
+    while j != -1:
+        out += buffer(deltas, 2*i, 2*(j - i))
+        out += "\x80\x02"
+        i = j
+        j = codes.find(move, j + 1)
+    
+    out += buffer(deltas, 2*i)
+
+
+def _encode_lead(out, block, x, y, cx, cy, limit):
+
+    """Appends the first coordinate pair of the given encoded block to the
+    bytearray out, changed to move from (cx, cy) to (x, y) instead.
+    
+    A pair that would be too long is preceded by the moves needed to bring it
+    within the limit, keeping its original form as a move or a plain pair so
+    that the rest of the block is read in the same way as before."""
+    
+    dx, dy = x - cx, y - cy
+    steps = max(1, -(-max(abs(dx), abs(dy)) // limit))
+    
+    xs = array("i", [cx + (dx * step) // steps for step in xrange(1, steps + 1)])
+    ys = array("i", [cy + (dy * step) // steps for step in xrange(1, steps + 1)])
+    commands = array("B", [MOVE]) * steps
+    if block.data[block.start:block.start + 2] != "\x80\x02":
+        commands[-1] = STITCH
+    
+    _encode_thread(out, xs, ys, commands, cx, cy, limit)
+
+
+def encode_stitches(stitches, out = None, max_length = 127, blocks = None):
+
+    """Encodes the threads in the given Stitches object as JEF stitch data,
+    appending it to the bytearray out, which is created if not given, and
+    returning the bytearray.
+    
+    Moves and stitches that are longer than max_length units in either
+    direction are encoded as several shorter ones. The length cannot be more
+    than 127 because a value of -128 would be read as a control code.
+    
+    Threads that have not been modified since they were decoded are copied
+    from their original data, with only their first coordinate pair encoded
+    again if the thread before them ends in a different place. If a blocks
+    list is given, it is extended with (start, first_end, end) tuples giving
+    the indices in out of each thread, the end of its first coordinate and
+    the end of its data."""
+    
+    limit = max(1, min(int(max_length), 127))
+    
+    if out is None:
+        out = bytearray()
+    
+    x, y = 0, 0
+    for index in xrange(len(stitches)):
+    
+        if index > 0:
+            out += "\x80\x01\x00\x00"
+        
+        xs, ys, commands, start, end = stitches.thread_columns(index)
+        block = stitches.blocks[index]
+        begin = len(out)
+        
+        if start == end:
+            first_end = begin
+        
+        elif block and (x, y) == (block.x, block.y):
+            out += buffer(block.data, block.start, block.end - block.start)
+            first_end = begin + block.first_end - block.start
+        
+        elif block:
+            _encode_lead(out, block, xs[start], ys[start], x, y, limit)
+            first_end = len(out)
+            out += buffer(block.data, block.first_end, block.end - block.first_end)
+        
+        else:
+            # Encode the first coordinate separately to find where the rest
+            # of the thread begins.
+            _encode_thread(out, xs[start:start + 1], ys[start:start + 1],
+                           commands[start:start + 1], x, y, limit)
+            first_end = len(out)
+            if end > start + 1:
+                _encode_thread(out, xs[start + 1:end], ys[start + 1:end],
+                               commands[start + 1:end], xs[start], ys[start], limit)
+        
+        if blocks is not None:
+            blocks.append((begin, first_end, len(out)))
+        
+        if start < end:
+            x, y = xs[end - 1], ys[end - 1]
+    
+    out += "\x80\x10"
+    return out
+
+
+def _columns(coordinates):
+
+    """Returns arrays of x coordinates, y coordinates and commands for the
+    given sequence of (command, x, y) tuples or Thread object."""
+    
+    if isinstance(coordinates, Thread):
+        return coordinates.x, coordinates.y, coordinates.commands
+    
+    xs, ys, commands = array("i"), array("i"), array("B")
+    if coordinates:
+        names, x, y = zip(*coordinates)
+        xs.fromlist(list(x))
+        ys.fromlist(list(y))
+        commands.fromlist(map(command_codes.__getitem__, names))
+    
+    return xs, ys, commands
+
+
+def _extent(xs, ys, start, end):
+
+    """Returns the smallest and largest coordinates found between the start
+    and end indices of the xs and ys arrays as a tuple (x1, y1, x2, y2), or
+    None if the range is empty."""
+    
+    if start >= end:
+        return None
+    
+    if numpy:
+        xs = numpy.frombuffer(xs, numpy.int32)[start:end]
+        ys = numpy.frombuffer(ys, numpy.int32)[start:end]
+        return (int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max()))
+    else:
+        xs, ys = xs[start:end], ys[start:end]
+        return (min(xs), min(ys), max(xs), max(ys))
+
+
+def _union(a, b):
+
+    """Returns the smallest extent containing the extents a and b, either of
+    which may be None."""
+    
+    if a is None:
+        return b
+    elif b is None:
+        return a
+    
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def _round(value):
+
+    return int(math.floor(value + 0.5))
+
+
+def _transform_rect(matrix, rect):
+
+    """Returns the smallest rectangle containing the corners of the given
+    (x1, y1, x2, y2) rectangle transformed by the affine matrix, given as a
+    tuple (a, b, c, d, e, f)."""
+    
+    a, b, c, d, e, f = matrix
+    x1, y1, x2, y2 = rect
+    xs, ys = [], []
+    for x, y in (x1, y1), (x2, y1), (x1, y2), (x2, y2):
+        xs.append(_round(a * x + b * y + e))
+        ys.append(_round(c * x + d * y + f))
+    
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+class Thread(object):
+
+    """Thread
+    
+    A view onto the coordinates of a single thread, held in the arrays of a
+    Stitches object between the start and end indices. Items are returned as
+    (command, x, y) tuples for compatibility with code that expects lists of
+    tuples, while the x, y and commands attributes return arrays.
+    """
+    
+    def __init__(self, x, y, commands, start, end):
+    
+        self._x = x
+        self._y = y
+        self._commands = commands
+        self.start = start
+        self.end = end
+    
+    def __len__(self):
+    
+        return self.end - self.start
+    
+    def __getitem__(self, index):
+    
+        if isinstance(index, slice):
+            start, end, step = index.indices(len(self))
+            return list(self)[start:end:step]
+        
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("thread index out of range")
+        
+        i = self.start + index
+        return (command_names[self._commands[i]], self._x[i], self._y[i])
+    
+    def __iter__(self):
+    
+        return izip(map(command_names.__getitem__, self.commands), self.x, self.y)
+    
+    def __eq__(self, other):
+    
+        try:
+            return len(self) == len(other) and list(self) == list(other)
+        except TypeError:
+            return False
+    
+    def __ne__(self, other):
+    
+        return not self == other
+    
+    @property
+    def x(self):
+        return self._x[self.start:self.end]
+    
+    @property
+    def y(self):
+        return self._y[self.start:self.end]
+    
+    @property
+    def commands(self):
+        return self._commands[self.start:self.end]
+    
+    def simplify(self, tolerance):
+    
+        """Returns a new Thread holding a simplified copy of the thread's
+        coordinates; see the simplify function."""
+        
+        xs, ys, commands = simplify(self.x, self.y, self.commands, tolerance)
+        return Thread(xs, ys, commands, 0, len(commands))
+
+
+class Stitches(object):
+
+    """Stitches
+    
+    Holds the coordinates and commands of all the threads in a pattern in
+    columns: arrays of 32-bit x and y coordinates and an array of 8-bit
+    commands (STITCH or MOVE). The offsets array contains the index of the
+    first stitch in each thread, followed by the total number of stitches.
+    
+    Indexing and iterating return Thread objects, so that a Stitches object
+    can be used in place of a list of lists of (command, x, y) tuples.
+    
+    The blocks list holds a Block for each thread describing its encoded
+    form, or None if the thread has been modified since it was decoded or
+    saved. The extents of the threads and of the whole pattern are cached
+    when first requested. Code that changes the arrays directly should call
+    mark_modified() for each thread it changes.
+    """
+    
+    def __init__(self, x = None, y = None, commands = None, offsets = None,
+                       blocks = None):
+        
+        if x is None:
+            x, y, commands, offsets = array("i"), array("i"), array("B"), array("I", [0])
+        
+        self.x = x
+        self.y = y
+        self.commands = commands
+        self.offsets = offsets
+        self.blocks = blocks or [None] * (len(offsets) - 1)
+        
+        # Set when threads are replaced or appended.
+        self.modified = False
+        
+        # Cached extents of threads, by index, and of the whole pattern.
+        self._extents = {}
+        self._extent = None
+        self._extent_known = False
+    
+    @classmethod
+    def decode(cls, data, start = 0, end = None):
+    
+        """Returns a Stitches object containing the threads decoded from the
+        stitch data in data[start:end], recording where each of them is
+        found in the data."""
+        
+        ranges = []
+        xs, ys, commands, offsets = decode_stitches(data, start, end, ranges)
+        stitches = cls(xs, ys, commands, offsets)
+        stitches.set_blocks(data, ranges)
+        return stitches
+    
+    def set_blocks(self, data, ranges):
+    
+        """Records the encoded form of each thread, given the data containing
+        it and a list of (start, first_end, end) tuples describing where each
+        thread is found in the data."""
+        
+        self.blocks = []
+        for i, (start, first_end, end) in enumerate(ranges):
+            k = self.offsets[i]
+            if k > 0:
+                x, y = self.x[k - 1], self.y[k - 1]
+            else:
+                x, y = 0, 0
+            self.blocks.append(Block(data, start, first_end, end, x, y))
+        
+        self.modified = False
+    
+    def mark_modified(self, index):
+    
+        """Records that the thread with the given index has been changed."""
+        
+        self.blocks[index] = None
+        self.modified = True
+        
+        self._extents.pop(index, None)
+        self._extent_known = False
+    
+    def __len__(self):
+    
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, index):
+    
+        if isinstance(index, slice):
+            return map(self.__getitem__, xrange(*index.indices(len(self))))
+        
+        return Thread(*self.thread_columns(index))
+    
+    def __setitem__(self, index, coordinates):
+    
+        """Replaces the coordinates of the thread with the given index with
+        a sequence of (command, x, y) tuples."""
+        
+        if index < 0:
+            index += len(self)
+        
+        x, y, commands, start, end = self.thread_columns(index)
+        new_x, new_y, new_commands = _columns(coordinates)
+        
+        self.x[start:end] = new_x
+        self.y[start:end] = new_y
+        self.commands[start:end] = new_commands
+        
+        change = len(new_commands) - (end - start)
+        if change:
+            for i in xrange(index + 1, len(self.offsets)):
+                self.offsets[i] += change
+        
+        self.mark_modified(index)
+    
+    def __iter__(self):
+    
+        for i in xrange(len(self)):
+            yield self[i]
+    
+    def __eq__(self, other):
+    
+        try:
+            return len(self) == len(other) and list(self) == list(other)
+        except TypeError:
+            return False
+    
+    def __ne__(self, other):
+    
+        return not self == other
+    
+    def append(self, coordinates):
+    
+        """Appends a thread described by a sequence of (command, x, y)
+        tuples."""
+        
+        x, y, commands = _columns(coordinates)
+        self.x.extend(x)
+        self.y.extend(y)
+        self.commands.extend(commands)
+        self.offsets.append(len(self.commands))
+        self.blocks.append(None)
+        self.modified = True
+        
+        # The new thread's extent can be merged into the cached extent of the
+        # pattern without examining the other threads.
+        index = len(self) - 1
+        extent = _extent(self.x, self.y, self.offsets[index], self.offsets[index + 1])
+        self._extents[index] = extent
+        if self._extent_known:
+            self._extent = _union(self._extent, extent)
+    
+    def thread_columns(self, index):
+    
+        """Returns the x, y and commands arrays and the range of indices within
+        them that holds the thread with the given index."""
+        
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("thread index out of range")
+        
+        return self.x, self.y, self.commands, self.offsets[index], self.offsets[index + 1]
+    
+    def stitch_count(self):
+    
+        return len(self.commands)
+    
+    def thread_extent(self, index):
+    
+        """Returns the smallest and largest coordinates in the thread with the
+        given index as a tuple (x1, y1, x2, y2), or None if it is empty."""
+        
+        if index < 0:
+            index += len(self)
+        
+        try:
+            return self._extents[index]
+        except KeyError:
+            x, y, commands, start, end = self.thread_columns(index)
+            extent = self._extents[index] = _extent(x, y, start, end)
+            return extent
+    
+    def extent(self):
+    
+        """Returns the smallest and largest coordinates in all the threads as
+        a tuple (x1, y1, x2, y2), or None if there are no stitches."""
+        
+        if not self._extent_known:
+            extent = None
+            for i in xrange(len(self)):
+                extent = _union(extent, self.thread_extent(i))
+            self._extent = extent
+            self._extent_known = True
+        
+        return self._extent
+    
+    def transform(self, a, b, c, d, e = 0, f = 0):
+    
+        """Moves each point (x, y) to (a*x + b*y + e, c*x + d*y + f), rounded
+        to the nearest unit.
+        
+        The encoded form of each thread is kept for translations by whole
+        units, which only change the first coordinate of the first thread.
+        Cached extents are transformed along with the points if the
+        transformation maps horizontal and vertical lines to horizontal and
+        vertical lines, and are discarded otherwise."""
+        
+        matrix = (a, b, c, d, e, f)
+        self._transform(matrix)
+        
+        if (a, b, c, d) == (1, 0, 0, 1) and e == int(e) and f == int(f):
+            self.blocks = [block and block._replace(x = block.x + int(e), y = block.y + int(f))
+                           for block in self.blocks]
+        else:
+            self.blocks = [None] * len(self)
+        self.modified = True
+        
+        if b == c == 0 or a == d == 0:
+            for index, extent in self._extents.items():
+                self._extents[index] = extent and _transform_rect(matrix, extent)
+            if self._extent:
+                self._extent = _transform_rect(matrix, self._extent)
+        else:
+            self._extents = {}
+            self._extent_known = False
+    
+    def _transform(self, matrix):
+    
+        a, b, c, d, e, f = matrix
+        
+        if numpy and self.commands:
+            xs = numpy.frombuffer(self.x, numpy.int32).astype(numpy.float64)
+            ys = numpy.frombuffer(self.y, numpy.int32).astype(numpy.float64)
+            new_xs = numpy.floor(a * xs + b * ys + (e + 0.5))
+            new_ys = numpy.floor(c * xs + d * ys + (f + 0.5))
+            self.x = array("i", new_xs.astype(numpy.int32).tostring())
+            self.y = array("i", new_ys.astype(numpy.int32).tostring())
+        elif (a, b, c, d) == (1, 0, 0, 1) and e == int(e) and f == int(f):
+            self.x = array("i", map(int(e).__add__, self.x))
+            self.y = array("i", map(int(f).__add__, self.y))
+        else:
+            xs, ys = self.x, self.y
+            self.x = array("i", [_round(a * x + b * y + e) for x, y in izip(xs, ys)])
+            self.y = array("i", [_round(c * x + d * y + f) for x, y in izip(xs, ys)])
+
+
+def stitch_lengths(xs, ys, commands, x = 0, y = 0):
+
+    """Returns the length of each stitch in the given arrays in tenths of a
+    millimetre, starting from the position (x, y), or 0 for each move, as a
+    NumPy array if NumPy is available or a list otherwise."""
+    
+    if not commands:
+        return []
+    
+    dxs = _differences(xs, x)
+    dys = _differences(ys, y)
+    
+    if numpy:
+        lengths = numpy.hypot(dxs, dys)
+        lengths[numpy.frombuffer(commands, numpy.uint8) != STITCH] = 0
+        return lengths
+    
+    return [length if command == STITCH else 0.0
+            for length, command in izip(map(math.hypot, dxs, dys), commands)]
+
+
+def simplify(xs, ys, commands, tolerance):
+
+    """Returns new arrays of x coordinates, y coordinates and commands
+    describing the same lines as the given arrays to within the given
+    tolerance in tenths of a millimetre, but usually with fewer points.
+    
+    Points between stitches that continue in the same direction are left
+    out first, since they lie on the line joining their neighbours. The
+    remaining points are assigned to the cells of a square grid small enough
+    that any two points in a cell are within the tolerance of each other. Within
+    each run of stitches between moves, a stitch is left out if it joins the
+    same pair of cells as an earlier stitch in the run, in either direction,
+    or if it starts and ends in the same cell, so that satin and fill
+    stitches that pass back and forth over the same cells are reduced to a
+    few lines. Moves and the stitches before them are kept, so the jumps
+    between runs of stitches are unchanged.
+    
+    A stitch that is kept after some were left out is drawn from the last
+    point kept. If that point is not in the same cell as the point the
+    stitch really starts from, that point is also kept as a move, so that
+    every line drawn is close to a stitch in the design."""
+    
+    n = len(commands)
+    if tolerance <= 0 or n < 3:
+        return array("i", xs), array("i", ys), array("B", commands)
+    
+    size = tolerance / math.sqrt(2)
+    
+    if numpy:
+        x = numpy.frombuffer(xs, numpy.int32)
+        y = numpy.frombuffer(ys, numpy.int32)
+        c = numpy.frombuffer(commands, numpy.uint8)
+        stitch = c == STITCH
+        
+        # Leave out the points in the middle of straight lines of stitches.
+        dx = numpy.diff(x.astype(numpy.int64))
+        dy = numpy.diff(y.astype(numpy.int64))
+        keep = numpy.ones(n, bool)
+        keep[1:-1] = ~(stitch[1:-1] & stitch[2:] & (dx[:-1] * dy[1:] == dy[:-1] * dx[1:]) &
+                       (dx[:-1] * dx[1:] + dy[:-1] * dy[1:] > 0))
+        x, y, c = x[keep], y[keep], c[keep]
+        n = len(c)
+        
+        cx = numpy.floor(x / size).astype(numpy.int64)
+        cy = numpy.floor(y / size).astype(numpy.int64)
+        stitch = c == STITCH
+        
+        # Number the cells, then describe each stitch by the numbers of the
+        # cells at each end, in order, and find the first stitch with each
+        # description in each run.
+        cx -= cx.min()
+        cy -= cy.min()
+        height = int(cy.max()) + 1
+        cells = (int(cx.max()) + 1) * height
+        if cells < 2**31:
+            cell = cx * height + cy
+        else:
+            used, cell = numpy.unique(cx + 1j * cy, return_inverse = True)
+            cells = len(used)
+        
+        same = cell[1:] == cell[:-1]
+        k = numpy.flatnonzero(stitch[1:]) + 1
+        pair = numpy.minimum(cell[k - 1], cell[k]) * cells + numpy.maximum(cell[k - 1], cell[k])
+        run = numpy.cumsum(~stitch)[k]
+        order = numpy.argsort(pair, kind = "mergesort")
+        pair, run = pair[order], run[order]
+        first = numpy.ones(len(k), bool)
+        first[1:] = (pair[1:] != pair[:-1]) | (run[1:] != run[:-1])
+        
+        keep = ~stitch
+        keep[k[order[first]]] = True
+        keep[1:] &= ~same | ~stitch[1:]
+        keep[:-1] |= ~stitch[1:]
+        keep[0] = keep[-1] = True
+        
+        # Keep the start of each stitch drawn from a point in another cell,
+        # as a move.
+        kept = numpy.flatnonzero(keep)
+        before = numpy.flatnonzero(keep[1:] & ~keep[:-1] & stitch[1:])
+        last = kept[numpy.searchsorted(kept, before) - 1]
+        before = before[cell[last] != cell[before]]
+        keep[before] = True
+        c[before] = MOVE
+        
+        return (array("i", x[keep].tostring()), array("i", y[keep].tostring()),
+                array("B", c[keep].tostring()))
+    
+    # Leave out the points in the middle of straight lines of stitches.
+    straight = set()
+    for i in xrange(1, n - 1):
+        if commands[i] == STITCH and commands[i + 1] == STITCH:
+            ax, ay = xs[i] - xs[i - 1], ys[i] - ys[i - 1]
+            bx, by = xs[i + 1] - xs[i], ys[i + 1] - ys[i]
+            if ax * by == ay * bx and ax * bx + ay * by > 0:
+                straight.add(i)
+    
+    if straight:
+        xs = [x for i, x in enumerate(xs) if i not in straight]
+        ys = [y for i, y in enumerate(ys) if i not in straight]
+        commands = [command for i, command in enumerate(commands) if i not in straight]
+        n = len(commands)
+    
+    cells = [(math.floor(x / size), math.floor(y / size)) for x, y in izip(xs, ys)]
+    following = list(commands[1:]) + [MOVE]
+    
+    keep = [True]
+    seen = set()
+    for i in xrange(1, n):
+        if commands[i] != STITCH:
+            keep.append(True)
+            seen = set()
+            continue
+        
+        key = tuple(sorted((cells[i - 1], cells[i])))
+        if i == n - 1 or following[i] != STITCH:
+            keep.append(True)
+        else:
+            keep.append(key[0] != key[1] and key not in seen)
+        seen.add(key)
+    
+    new_xs, new_ys, new_commands = array("i"), array("i"), array("B")
+    last = 0
+    for i in xrange(n):
+        if not keep[i]:
+            continue
+        if i > 0 and not keep[i - 1] and commands[i] == STITCH and \
+           cells[last] != cells[i - 1]:
+            new_xs.append(xs[i - 1])
+            new_ys.append(ys[i - 1])
+            new_commands.append(MOVE)
+        new_xs.append(xs[i])
+        new_ys.append(ys[i])
+        new_commands.append(commands[i])
+        last = i
+    
+    return new_xs, new_ys, new_commands
+
+
+def count_jumps(commands, offsets, command = MOVE):
+
+    """Returns a list containing the number of jumps in each thread in the
+    commands array, where offsets holds the index of the first command in
+    each thread followed by the total number of commands. A jump is a run of
+    moves that follows a stitch; the first command is preceded by the given
+    command and the first in each subsequent thread by a move."""
+    
+    codes = commands.tostring()
+    jump = chr(STITCH) + chr(MOVE)
+    
+    jumps = []
+    for start, end in izip(offsets, offsets[1:]):
+        n = codes.count(jump, start, end)
+        if start < end and command == STITCH and codes[start] == chr(MOVE):
+            n += 1
+        jumps.append(n)
+        command = MOVE
+    
+    return jumps
+
+
+def stitch_stats(xs, ys, commands, offsets, x = 0, y = 0, command = MOVE):
+
+    """Returns a list containing a ThreadStats for each thread in the given
+    columns of coordinates and commands, where offsets holds the index of the
+    first stitch in each thread followed by the total number of stitches.
+    
+    The first stitch is measured from the position (x, y) and follows the
+    given command, so that the stitches of a thread can be passed in several
+    parts; each subsequent thread is measured from the end of the one before
+    it."""
+    
+    codes = commands.tostring()
+    lengths = stitch_lengths(xs, ys, commands, x, y)
+    jumps = count_jumps(commands, offsets, command)
+    
+    stats = []
+    for (start, end), thread_jumps in izip(izip(offsets, offsets[1:]), jumps):
+    
+        part = lengths[start:end]
+        if start == end:
+            length = longest = 0.0
+        elif numpy:
+            length, longest = float(part.sum()), float(part.max())
+        else:
+            length, longest = sum(part), max(part)
+        
+        stitches = codes.count(chr(STITCH), start, end)
+        stats.append(ThreadStats(stitches, thread_jumps, length / 10.0, longest / 10.0))
+    
+    return stats
+
+
+def _pattern_stats(threads):
+
+    return PatternStats(threads,
+                        sum(thread.stitches for thread in threads),
+                        sum(thread.jumps for thread in threads),
+                        max(len(threads) - 1, 0),
+                        sum((thread.length for thread in threads), 0.0),
+                        max([thread.longest for thread in threads] or [0.0]))
+
+
+def stream_stats(f, block_size = 65536):
+
+    """Returns a PatternStats for the JEF file read from the file object f,
+    decoding its stitch data a block at a time with a StitchReader."""
+    
+    threads = []
+    x, y, command = 0, 0, MOVE
+    
+    for thread, xs, ys, commands in StitchReader(f, block_size).chunks(block_size):
+    
+        if thread == len(threads):
+            threads.append(ThreadStats(0, 0, 0.0, 0.0))
+            command = MOVE
+        
+        stats = stitch_stats(xs, ys, commands, [0, len(commands)], x, y, command)[0]
+        total = threads[thread]
+        threads[thread] = ThreadStats(total.stitches + stats.stitches,
+                                      total.jumps + stats.jumps,
+                                      total.length + stats.length,
+                                      max(total.longest, stats.longest))
+        
+        x, y, command = xs[-1], ys[-1], commands[-1]
+    
+    return _pattern_stats(threads)
+
+
+class _Fingerprint:
+
+    """_Fingerprint
+    
+    Hashes the canonical form of a stitch stream passed to it one part at a
+    time. Each point is recorded as a (command, dx, dy) triple of 32-bit
+    little-endian integers measured from the previous point, the header and
+    thread colours are ignored, and each run of moves is replaced by a single
+    move to the point at its end so that the way a jump was split does not
+    matter. Threads are separated by a (-1, 0, 0) triple; threads without any
+    points are left out.
+    """
+    
+    separator = struct.pack("<iii", -1, 0, 0)
+    
+    def __init__(self, invariant = False):
+    
+        self.hash = hashlib.sha1()
+        self.invariant = invariant
+        self.thread = None
+        self.position = None
+        self.pending = None
+        self.separate = False
+    
+    def add(self, thread, xs, ys, commands):
+    
+        """Adds the points in the arrays to the hash, where thread is the
+        index of the thread they belong to."""
+        
+        if thread != self.thread:
+            self._flush()
+            self.thread = thread
+            self.separate = self.position is not None
+        
+        if not commands:
+            return
+        
+        if self.pending is not None:
+            if commands[0] != MOVE:
+                self._flush()
+            self.pending = None
+        
+        # A move is only kept if it is not followed by another one; the last
+        # one in the arrays is held back until the next point is known.
+        if commands[-1] == MOVE:
+            self.pending = xs[-1], ys[-1]
+        
+        if numpy:
+            c = numpy.frombuffer(commands, numpy.uint8)
+            keep = c != MOVE
+            keep[:-1] |= c[1:] != MOVE
+            self._emit(numpy.frombuffer(xs, numpy.int32)[keep],
+                       numpy.frombuffer(ys, numpy.int32)[keep], c[keep])
+        else:
+            following = list(commands[1:]) + [MOVE]
+            keep = [command != MOVE or next != MOVE
+                    for command, next in izip(commands, following)]
+            self._emit([x for x, k in izip(xs, keep) if k],
+                       [y for y, k in izip(ys, keep) if k],
+                       [c for c, k in izip(commands, keep) if k])
+    
+    def _flush(self):
+    
+        if self.pending is not None:
+            x, y = self.pending
+            self.pending = None
+            self._emit([x], [y], [MOVE])
+    
+    def _emit(self, xs, ys, commands):
+    
+        n = len(commands)
+        if not n:
+            return
+        
+        if self.position is None:
+            self.position = (xs[0], ys[0]) if self.invariant else (0, 0)
+        
+        if self.separate:
+            self.hash.update(self.separator)
+            self.separate = False
+        
+        x, y = self.position
+        
+        if numpy:
+            records = numpy.empty((n, 3), numpy.int32)
+            records[:, 0] = commands
+            for column, values, previous in (1, xs, x), (2, ys, y):
+                values = numpy.asarray(values, numpy.int32)
+                records[0, column] = values[0] - previous
+                numpy.subtract(values[1:], values[:-1], records[1:, column])
+            self.hash.update(records.astype("<i4").tostring())
+        else:
+            records = array("i")
+            for record in izip(commands, _differences(array("i", xs), x),
+                               _differences(array("i", ys), y)):
+                records.extend(record)
+            if sys.byteorder == "big":
+                records.byteswap()
+            self.hash.update(records.tostring())
+        
+        self.position = xs[-1], ys[-1]
+    
+    def hexdigest(self):
+    
+        self._flush()
+        return self.hash.hexdigest()
+
+
+def fingerprint(f, invariant = False, block_size = 65536):
+
+    """Returns a hexadecimal string identifying the stitches in the JEF file
+    read from the file object f, decoding its stitch data a block at a time
+    with a StitchReader.
+    
+    Files with the same stitches have the same fingerprint even if their
+    headers, thread colours or the way their jumps are split differ, so
+    duplicate designs can be found by comparing fingerprints. If invariant is
+    True, the position of the design is also ignored, so that copies of it
+    that have been moved have the same fingerprint."""
+    
+    hasher = _Fingerprint(invariant)
+    for thread, xs, ys, commands in StitchReader(f, block_size).chunks(block_size):
+        hasher.add(thread, xs, ys, commands)
+    
+    return hasher.hexdigest()
+
+
+def _runs(xs, ys, commands, offsets):
+
+    """Returns arrays of the (dx, dy, command) values and lengths of the runs
+    of identical stitches in each of the threads in the given columns, an
+    array of the index of the first run in each thread followed by the total
+    number of runs, and arrays of the x and y coordinates of the first stitch
+    in each thread. The first stitch in each thread starts a run with a
+    delta of (0, 0)."""
+    
+    n = len(commands)
+    
+    if numpy:
+        starts = numpy.asarray(offsets, numpy.intp)
+        firsts = starts[:-1][starts[:-1] < n]
+        values = []
+        for v in xs, ys:
+            v = numpy.frombuffer(v, numpy.int32) if n else numpy.zeros(0, numpy.int32)
+            d = numpy.zeros(n, numpy.int32)
+            numpy.subtract(v[1:], v[:-1], d[1:])
+            d[firsts] = 0
+            values.append((v, d))
+        (x, dx), (y, dy) = values
+        c = numpy.frombuffer(commands, numpy.uint8) if n else numpy.zeros(0, numpy.uint8)
+        
+        change = numpy.ones(n, bool)
+        change[1:] = (dx[1:] != dx[:-1]) | (dy[1:] != dy[:-1]) | (c[1:] != c[:-1])
+        change[firsts] = True
+        first = numpy.flatnonzero(change)
+        counts = numpy.diff(numpy.append(first, n))
+        
+        dx, dy = dx[first], dy[first]
+        if not n or (-128 <= min(dx.min(), dy.min()) and max(dx.max(), dy.max()) <= 127):
+            typecode = "b"
+        else:
+            typecode = "i"
+        
+        origins_x, origins_y = numpy.zeros((2, len(starts) - 1), numpy.int32)
+        nonempty = starts[:-1] < starts[1:]
+        origins_x[nonempty] = x[starts[:-1][nonempty]]
+        origins_y[nonempty] = y[starts[:-1][nonempty]]
+        
+        return (array(typecode, dx.astype(typecode).tostring()),
+                array(typecode, dy.astype(typecode).tostring()),
+                array("B", c[first].tostring()),
+                array("I", counts.astype(numpy.uint32).tostring()),
+                array("I", numpy.searchsorted(first, starts).astype(numpy.uint32).tostring()),
+                array("i", origins_x.tostring()), array("i", origins_y.tostring()))
+    
+    run_dx, run_dy, run_commands, counts = [], [], [], []
+    runs, origins_x, origins_y = array("I"), array("i"), array("i")
+    
+    for start, end in izip(offsets, offsets[1:]):
+    
+        runs.append(len(counts))
+        if start == end:
+            origins_x.append(0)
+            origins_y.append(0)
+            continue
+        
+        origins_x.append(xs[start])
+        origins_y.append(ys[start])
+        previous = None
+        x, y = xs[start], ys[start]
+        
+        for i in xrange(start, end):
+            value = (xs[i] - x, ys[i] - y, commands[i])
+            x, y = xs[i], ys[i]
+            if value == previous:
+                counts[-1] += 1
+            else:
+                run_dx.append(value[0])
+                run_dy.append(value[1])
+                run_commands.append(value[2])
+                counts.append(1)
+                previous = value
+    
+    runs.append(len(counts))
+    
+    if not run_dx or (-128 <= min(run_dx + run_dy) and max(run_dx + run_dy) <= 127):
+        typecode = "b"
+    else:
+        typecode = "i"
+    
+    return (array(typecode, run_dx), array(typecode, run_dy),
+            array("B", run_commands), array("I", counts), runs,
+            origins_x, origins_y)
+
+
+def _widen(a, b):
+
+    """Returns the arrays a and b, converting one of them to hold 32-bit
+    integers if the other does. An empty array is converted to match the
+    other one instead, so that empty threads do not widen the deltas."""
+    
+    if a.typecode != b.typecode:
+        if not b:
+            b = array(a.typecode)
+        elif not a:
+            a = array(b.typecode)
+        else:
+            a, b = array("i", a), array("i", b)
+    
+    return a, b
+
+
+class _SplitStitches(Stitches):
+
+    """_SplitStitches
+    
+    A base class for containers that do not hold the threads in shared
+    arrays, whose thread_columns() methods return new arrays for each thread.
+    The x, y and commands attributes return arrays holding all the threads.
+    """
+    
+    def set_blocks(self, data, ranges):
+    
+        self.blocks = []
+        x, y = 0, 0
+        for i, (start, first_end, end) in enumerate(ranges):
+            self.blocks.append(Block(data, start, first_end, end, x, y))
+            xs, ys, commands, start, end = self.thread_columns(i)
+            if start < end:
+                x, y = xs[end - 1], ys[end - 1]
+        
+        self.modified = False
+    
+    def _expand(self, column):
+    
+        values = array("iiB"[column])
+        for i in xrange(len(self)):
+            values.extend(self.thread_columns(i)[column])
+        return values
+    
+    @property
+    def x(self):
+    
+        return self._expand(0)
+    
+    @property
+    def y(self):
+    
+        return self._expand(1)
+    
+    @property
+    def commands(self):
+    
+        return self._expand(2)
+    
+    def stitch_count(self):
+    
+        return self.offsets[-1]
+
+
+class RunLengthStitches(_SplitStitches):
+
+    """RunLengthStitches
+    
+    Holds the same information as a Stitches object in a more compact form,
+    storing each run of stitches with identical (dx, dy, command) values as
+    a single entry with a count. Fill stitches made with a constant step are
+    stored as a handful of runs instead of one entry per stitch.
+    
+    Threads are expanded to arrays of coordinates when they are indexed or
+    iterated over, and the x, y and commands attributes expand all of them.
+    Each thread is stored relative to the position of its first stitch so
+    that threads can be replaced without affecting the others.
+    """
+    
+    def __init__(self, x = None, y = None, commands = None, offsets = None,
+                       blocks = None):
+        
+        if x is None:
+            x, y, commands, offsets = array("i"), array("i"), array("B"), array("I", [0])
+        
+        (self.dx, self.dy, self.run_commands, self.counts, self.runs,
+         self.origins_x, self.origins_y) = _runs(x, y, commands, offsets)
+        
+        self.offsets = array("I", offsets)
+        self.blocks = blocks or [None] * (len(offsets) - 1)
+        self.modified = False
+        
+        self._extents = {}
+        self._extent = None
+        self._extent_known = False
+    
+    def _end(self, index):
+    
+        """Returns the position of the last stitch in the non-empty thread
+        with the given index."""
+        
+        r0, r1 = self.runs[index], self.runs[index + 1]
+        if numpy:
+            counts = numpy.frombuffer(self.counts, numpy.uint32)[r0:r1]
+            dx = numpy.dot(numpy.frombuffer(self.dx, self.dx.typecode)[r0:r1], counts)
+            dy = numpy.dot(numpy.frombuffer(self.dy, self.dy.typecode)[r0:r1], counts)
+        else:
+            counts = self.counts[r0:r1]
+            dx = sum(map(operator.mul, self.dx[r0:r1], counts))
+            dy = sum(map(operator.mul, self.dy[r0:r1], counts))
+        
+        return self.origins_x[index] + int(dx), self.origins_y[index] + int(dy)
+    
+    def set_blocks(self, data, ranges):
+    
+        self.blocks = []
+        x, y = 0, 0
+        for i, (start, first_end, end) in enumerate(ranges):
+            self.blocks.append(Block(data, start, first_end, end, x, y))
+            if self.offsets[i] < self.offsets[i + 1]:
+                x, y = self._end(i)
+        
+        self.modified = False
+    
+    def __setitem__(self, index, coordinates):
+    
+        """Replaces the coordinates of the thread with the given index with
+        a sequence of (command, x, y) tuples."""
+        
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("thread index out of range")
+        
+        x, y, commands = _columns(coordinates)
+        dx, dy, run_commands, counts, runs, origins_x, origins_y = \
+            _runs(x, y, commands, array("I", [0, len(commands)]))
+        
+        r0, r1 = self.runs[index], self.runs[index + 1]
+        self.dx, dx = _widen(self.dx, dx)
+        self.dy, dy = _widen(self.dy, dy)
+        self.dx[r0:r1] = dx
+        self.dy[r0:r1] = dy
+        self.run_commands[r0:r1] = run_commands
+        self.counts[r0:r1] = counts
+        
+        change = len(counts) - (r1 - r0)
+        if change:
+            for i in xrange(index + 1, len(self.runs)):
+                self.runs[i] += change
+        
+        change = len(commands) - (self.offsets[index + 1] - self.offsets[index])
+        if change:
+            for i in xrange(index + 1, len(self.offsets)):
+                self.offsets[i] += change
+        
+        self.origins_x[index] = origins_x[0]
+        self.origins_y[index] = origins_y[0]
+        self.mark_modified(index)
+    
+    def append(self, coordinates):
+    
+        """Appends a thread described by a sequence of (command, x, y)
+        tuples."""
+        
+        known, extent = self._extent_known, self._extent
+        
+        # Add an empty thread and replace it with the new coordinates.
+        self.runs.append(self.runs[-1])
+        self.offsets.append(self.offsets[-1])
+        self.origins_x.append(0)
+        self.origins_y.append(0)
+        self.blocks.append(None)
+        self[-1] = coordinates
+        
+        if known:
+            self._extent = _union(extent, self.thread_extent(-1))
+            self._extent_known = True
+    
+    def thread_columns(self, index):
+    
+        """Returns arrays holding the x and y coordinates and commands of the
+        thread with the given index and the range of indices within them that
+        holds the thread, which is the whole of each array."""
+        
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("thread index out of range")
+        
+        r0, r1 = self.runs[index], self.runs[index + 1]
+        x0, y0 = self.origins_x[index], self.origins_y[index]
+        
+        if numpy and r1 > r0:
+            counts = numpy.frombuffer(self.counts, numpy.uint32)[r0:r1]
+            dx = numpy.frombuffer(self.dx, self.dx.typecode)[r0:r1]
+            dy = numpy.frombuffer(self.dy, self.dy.typecode)[r0:r1]
+            commands = numpy.frombuffer(self.run_commands, numpy.uint8)[r0:r1]
+            xs = numpy.cumsum(numpy.repeat(dx, counts), dtype = numpy.int32)
+            ys = numpy.cumsum(numpy.repeat(dy, counts), dtype = numpy.int32)
+            xs += x0
+            ys += y0
+            xs, ys = array("i", xs.tostring()), array("i", ys.tostring())
+            commands = array("B", numpy.repeat(commands, counts).tostring())
+            return xs, ys, commands, 0, len(commands)
+        
+        xs, ys, commands = array("i"), array("i"), array("B")
+        for i in xrange(r0, r1):
+            count = self.counts[i]
+            xs.extend(array("i", [self.dx[i]]) * count)
+            ys.extend(array("i", [self.dy[i]]) * count)
+            commands.extend(array("B", [self.run_commands[i]]) * count)
+        
+        for values, total in (xs, x0), (ys, y0):
+            for k in xrange(len(values)):
+                total += values[k]
+                values[k] = total
+        
+        return xs, ys, commands, 0, len(commands)
+    
+    def _transform(self, matrix):
+    
+        a, b, c, d, e, f = matrix
+        
+        if a != int(a) or b != int(b) or c != int(c) or d != int(d):
+            # Rounding depends on the absolute positions of the stitches, so
+            # transform the expanded coordinates and find the runs again.
+            stitches = Stitches(self.x, self.y, self.commands, self.offsets)
+            stitches._transform(matrix)
+            (self.dx, self.dy, self.run_commands, self.counts, self.runs,
+             self.origins_x, self.origins_y) = _runs(stitches.x, stitches.y,
+                                                     stitches.commands, self.offsets)
+            return
+        
+        # With whole number coefficients, the deltas can be transformed
+        # exactly without reference to the positions of the stitches.
+        a, b, c, d = int(a), int(b), int(c), int(d)
+        if numpy and self.counts:
+            x = numpy.frombuffer(self.dx, self.dx.typecode).astype(numpy.int32)
+            y = numpy.frombuffer(self.dy, self.dy.typecode).astype(numpy.int32)
+            dx, dy = a * x + b * y, c * x + d * y
+            if -128 <= min(dx.min(), dy.min()) and max(dx.max(), dy.max()) <= 127:
+                typecode = "b"
+            else:
+                typecode = "i"
+            self.dx = array(typecode, dx.astype(typecode).tostring())
+            self.dy = array(typecode, dy.astype(typecode).tostring())
+        else:
+            dx = [a * x + b * y for x, y in izip(self.dx, self.dy)]
+            dy = [c * x + d * y for x, y in izip(self.dx, self.dy)]
+            if dx and -128 <= min(dx + dy) and max(dx + dy) <= 127:
+                typecode = "b"
+            else:
+                typecode = "i"
+            self.dx, self.dy = array(typecode, dx), array(typecode, dy)
+        
+        origins = zip(self.origins_x, self.origins_y)
+        self.origins_x = array("i", [_round(a * x + b * y + e) for x, y in origins])
+        self.origins_y = array("i", [_round(c * x + d * y + f) for x, y in origins])
+
+
+class FrozenStitches(_SplitStitches):
+
+    """FrozenStitches
+    
+    An immutable copy of a Stitches object, holding the coordinates and
+    commands in strings. Indexing returns Thread objects with their own
+    arrays, so changes made through them do not affect the original, and the
+    extents of the threads are found when the copy is made, so that it can be
+    read from several threads at once without locking. Methods that would
+    change the stitches raise TypeError.
+    """
+    
+    def __init__(self, stitches):
+    
+        self._x = stitches.x.tostring()
+        self._y = stitches.y.tostring()
+        self._commands = stitches.commands.tostring()
+        self._offsets = tuple(stitches.offsets)
+        self._blocks = tuple(stitches.blocks)
+        self._modified = stitches.modified
+        
+        self._extents = dict((i, stitches.thread_extent(i)) for i in xrange(len(stitches)))
+        self._extent = stitches.extent()
+        self._extent_known = True
+    
+    @classmethod
+    def decode(cls, data, start = 0, end = None):
+    
+        return cls(Stitches.decode(data, start, end))
+    
+    @classmethod
+    def _from_buffers(cls, x, y, commands, offsets, extents):
+    
+        """Returns a FrozenStitches object that reads its coordinates and
+        commands from the given strings or buffers, with the given offsets
+        and list of thread extents."""
+        
+        stitches = cls.__new__(cls)
+        stitches._x, stitches._y, stitches._commands = x, y, commands
+        stitches._offsets = tuple(offsets)
+        stitches._blocks = (None,) * len(extents)
+        stitches._modified = True
+        
+        stitches._extents = dict(enumerate(extents))
+        stitches._extent = reduce(_union, extents, None)
+        stitches._extent_known = True
+        return stitches
+    
+    @property
+    def offsets(self):
+    
+        return self._offsets
+    
+    @property
+    def blocks(self):
+    
+        return self._blocks
+    
+    @property
+    def modified(self):
+    
+        return self._modified
+    
+    def _read_only(self, *args, **kwargs):
+    
+        raise TypeError("FrozenStitches objects cannot be modified")
+    
+    set_blocks = mark_modified = __setitem__ = append = transform = _read_only
+    
+    def thread_columns(self, index):
+    
+        """Returns new arrays holding the x and y coordinates and commands of
+        the thread with the given index, and the range of indices within them
+        that holds the thread, which is the whole of each array."""
+        
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("thread index out of range")
+        
+        start, end = self._offsets[index], self._offsets[index + 1]
+        xs, ys, commands = array("i"), array("i"), array("B")
+        xs.fromstring(self._x[4 * start:4 * end])
+        ys.fromstring(self._y[4 * start:4 * end])
+        commands.fromstring(self._commands[start:end])
+        return xs, ys, commands, 0, end - start
+    
+    @property
+    def x(self):
+    
+        return array("i", str(self._x))
+    
+    @property
+    def y(self):
+    
+        return array("i", str(self._y))
+    
+    @property
+    def commands(self):
+    
+        return array("B", str(self._commands))
+
+
+class CopyOnWriteStitches(_SplitStitches):
+
+    """CopyOnWriteStitches
+    
+    A modifiable view of a FrozenStitches object that reads unchanged threads
+    from it and holds its own arrays only for the threads that are replaced
+    or appended.
+    """
+    
+    def __init__(self, frozen):
+    
+        self.base = frozen
+        self.offsets = array("I", frozen.offsets)
+        self.blocks = list(frozen.blocks)
+        self.modified = frozen.modified
+        
+        # The arrays for each thread that has been replaced, or None.
+        self._threads = [None] * len(frozen)
+        
+        self._extents = dict(frozen._extents)
+        self._extent = frozen._extent
+        self._extent_known = frozen._extent_known
+    
+    def __setitem__(self, index, coordinates):
+    
+        """Replaces the coordinates of the thread with the given index with
+        a sequence of (command, x, y) tuples."""
+        
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("thread index out of range")
+        
+        x, y, commands = _columns(coordinates)
+        self._threads[index] = (array("i", x), array("i", y), array("B", commands))
+        
+        change = len(commands) - (self.offsets[index + 1] - self.offsets[index])
+        if change:
+            for i in xrange(index + 1, len(self.offsets)):
+                self.offsets[i] += change
+        
+        self.mark_modified(index)
+    
+    def append(self, coordinates):
+    
+        """Appends a thread described by a sequence of (command, x, y)
+        tuples."""
+        
+        x, y, commands = _columns(coordinates)
+        self._threads.append((array("i", x), array("i", y), array("B", commands)))
+        self.offsets.append(self.offsets[-1] + len(commands))
+        self.blocks.append(None)
+        self.modified = True
+        
+        extent = _extent(x, y, 0, len(commands))
+        self._extents[len(self) - 1] = extent
+        if self._extent_known:
+            self._extent = _union(self._extent, extent)
+    
+    def thread_columns(self, index):
+    
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("thread index out of range")
+        
+        if self._threads[index] is None:
+            return self.base.thread_columns(index)
+        
+        x, y, commands = self._threads[index]
+        return x, y, commands, 0, len(commands)
+    
+    def _transform(self, matrix):
+    
+        # Every thread changes, so each one is copied and transformed.
+        for i in xrange(len(self)):
+            x, y, commands, start, end = self.thread_columns(i)
+            part = Stitches(x, y, commands, array("I", [start, end]))
+            part._transform(matrix)
+            self._threads[i] = (part.x, part.y, part.commands)
+
 
-    def __init__(self, path = None):
+class Pattern(object):
+
+    # Set for patterns loaded with a preview budget until they are completed.
+    partial = False
+    
+    def __init__(self, path = None, lazy = False, compact = False, preview = None):
     
+        # The file whose stitch data matches the coordinates, if any.
+        self._file = None
+        
+        # Compact patterns hold their stitches in run-length form.
+        if compact:
+            self._stitches = RunLengthStitches
+        else:
+            self._stitches = Stitches
+        
         if path:
-            self.load(path)
+            self.load(path, lazy, preview)
         else:
             self.date_time = None
             self.threads = 0
@@ -37,109 +2222,181 @@ class Pattern:
             self.rectangles = []
             self.colours = []
             self.thread_types = []
-            self.coordinates = []
+            self.coordinates = self._stitches()
+    
+    @property
+    def coordinates(self):
     
-    def load(self, path):
+        # Decode the stitch data of a lazily loaded pattern on first use.
+        if self._coordinates is None:
+            self._coordinates = self._stitches.decode(self._data, self._start)
+        
+        return self._coordinates
+    
+    @coordinates.setter
+    def coordinates(self, coordinates):
     
-        self._data = d = open(path).read()
-        start = struct.unpack("<I", d[:4])[0]
-        data = d[start:]
+        # Accept lists of lists of (command, x, y) tuples from older code.
+        if not isinstance(coordinates, Stitches):
+            stitches = self._stitches()
+            for thread in coordinates:
+                stitches.append(thread)
+            coordinates = stitches
         
-        self.date_time = None
-        if struct.unpack("<I", d[4:8])[0] & 1:
-            self.date_time = time.strptime(d[8:22], "%Y%m%d%H%M%S")
+        self._coordinates = coordinates
+        self._file = None
+        self.partial = False
+    
+    def load(self, path, lazy = False, preview = None):
+    
+        """Loads the pattern from the file with the given path.
         
-        self.threads = struct.unpack("<I", d[24:28])[0]
-        data_length = struct.unpack("<I", d[28:32])[0] * 2
+        If lazy is True, the file is memory-mapped and only its header and
+        colour tables are read; the stitch data is decoded when the
+        coordinates attribute is first used.
         
-        # start + data_length should equal the file length.
+        If preview is given, the file is memory-mapped and at most that many
+        coordinates are decoded, spread evenly over the design (see
+        sample_stitches). If any are left out, the partial attribute is set
+        to True and the coordinates cannot be modified; the complete() method
+        decodes all the stitches, and is called by the methods that change
+        or save the pattern. Assigning new coordinates also ends the preview."""
         
-        hoop_code = struct.unpack("<I", d[32:36])[0]
+        f = open(path, "rb")
+        try:
+            if lazy or preview:
+                self._data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            else:
+                self._data = f.read()
+        except (mmap.error, ValueError):
+            # Empty files cannot be mapped.
+            self._data = f.read()
+        f.close()
         
-        # Determine the hoop size in millimetres.
-        if hoop_code == 0:
-            self.hoop_size = (126, 110)
-            self.hoop_name = "A"
-        elif hoop_code == 1:
-            self.hoop_size = (50, 50)
-            self.hoop_name = "C"
-        elif hoop_code == 2:
-            self.hoop_size = (140, 200)
-            self.hoop_name = "B"
-        elif hoop_code == 3:
-            self.hoop_size = (126, 110)
-            self.hoop_name = "F"
-        elif hoop_code == 4:
-            self.hoop_size = (230, 200)
-            self.hoop_name = "D"
+        header = read_header(self._data)
+        self._file = os.path.abspath(path)
+        self._start = start = header.start
+        self._data_length = header.data_length
+        self.date_time = header.date_time
+        self.threads = header.threads
+        self.hoop_size = header.hoop_size
+        self.hoop_name = header.hoop_name
+        self.rectangles = list(header.rectangles)
+        self.colours = list(header.colours)
+        self.thread_types = list(header.thread_types)
+        
+        # Blocks for the threads in a lazily loaded file, found on demand.
+        self._blocks = None
+        self.partial = False
+        
+        if preview:
+            xs, ys, commands, offsets, total = sample_stitches(
+                self._data, start, budget = preview)
+            if len(commands) < total:
+                # Keep the sample from being edited, since complete() replaces
+                # it with the full set of stitches.
+                self._coordinates = FrozenStitches(Stitches(xs, ys, commands, offsets))
+                self.partial = True
+            else:
+                self._coordinates = self._stitches.decode(self._data, start)
+        elif lazy:
+            self._coordinates = None
         else:
-            self.hoop_size = None
-            self.hoop_name = None
-        
-        # These are coordinates specifying rectangles for the pattern.
-        # It appears that the units are 0.2 mm.
-        self.rectangles = []
-        offset = 0x24
-        while offset < 0x74:
-        
-            x1 = struct.unpack("<i", d[offset:offset+4])[0]
-            y1 = struct.unpack("<i", d[offset+4:offset+8])[0]
-            x2 = struct.unpack("<i", d[offset+8:offset+12])[0]
-            y2 = struct.unpack("<i", d[offset+12:offset+16])[0]
-            
-            if x1 != -1 and y1 != -1 and x2 != -1 and y2 != -1:
-                self.rectangles.append((-x1, -y1, x2, y2))
-            offset += 16
+            self._coordinates = self._stitches.decode(self._data, start)
+    
+    def complete(self):
+    
+        """Replaces the coordinates of a pattern loaded with a preview budget
+        with all of its stitches, decoded from the data read when it was
+        loaded, so that the header is not read again. Nothing is done if the
+        pattern is not partial, which includes patterns whose coordinates
+        have been replaced since they were loaded."""
+        
+        if self.partial:
+            self._coordinates = self._stitches.decode(self._data, self._start)
+            self.partial = False
+    
+    def save(self, path, max_length = 127):
+    
+        """Saves the pattern to the file with the given path, returning True
+        if successful or False otherwise.
+        
+        If only the header or colour tables have changed since the pattern
+        was loaded from or saved to the same file, the changed bytes are
+        written over those in the file. Otherwise, the file is written in
+        full to a temporary file which then replaces the original. A partial
+        pattern is completed first."""
+        
+        self.complete()
         
-        if hoop_code & 1 == 0:
-            # The 4 byte words from 68 to 74 should all be -1.
-            pass
+        if self._can_patch(path):
+            return self._patch(path, self._header(self._data_length))
+        
+        self.threads = len(self.coordinates)
+        blocks = []
+        thread_data = encode_stitches(self.coordinates, max_length = max_length,
+                                      blocks = blocks)
+        header = self._header(len(thread_data))
+        
+        directory = os.path.dirname(os.path.abspath(path))
+        try:
+            fd, temp_path = tempfile.mkstemp(suffix = ".tmp", dir = directory)
+        except (IOError, OSError):
+            return False
         
-        # The colour table always seems to start at offset 0x74.
-        self.colours = []
-        self.thread_types = []
+        try:
+            f = os.fdopen(fd, "wb")
+            try:
+                f.write(header)
+                f.write(thread_data)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            
+            if os.path.exists(path):
+                shutil.copymode(path, temp_path)
+                if os.name == "nt":
+                    os.remove(path)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(temp_path, 0666 & ~umask)
+            
+            os.rename(temp_path, path)
         
-        colour_offset = 0x74
-        thread_type_offset = 0x74 + (4 * self.threads)
-        for i in range(self.threads):
+        except (IOError, OSError):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
         
-            self.colours.append(struct.unpack("<i", d[colour_offset:colour_offset+4])[0])
-            self.thread_types.append(struct.unpack("<i", d[thread_type_offset:thread_type_offset+4])[0])
-            colour_offset += 4
-            thread_type_offset += 4
+        self._data = str(header + thread_data)
+        self._file = os.path.abspath(path)
+        self._start = start = len(header)
+        self._data_length = len(thread_data)
         
-        self.read_threads(data)
+        # Later saves can copy the threads from the data just written.
+        blocks = [(start + i, start + j, start + k) for i, j, k in blocks]
+        self._coordinates.set_blocks(self._data, blocks)
+        return True
     
-    def save(self, path):
+    def _header(self, data_length):
     
-        self.threads = len(self.coordinates)
-        thread_data = self.write_threads()
+        """Returns a bytearray containing the file header and colour tables
+        for stitch data of the given length in bytes."""
+        
         start = 0x74 + (8 * self.threads)
         
-        self._data = ""
-        self._data += struct.pack("<I", start)  # data offset
-        self._data += struct.pack("<I", 1)      # date-time flag
+        header = bytearray()
+        header += _header_start.pack(start, 1)  # data offset, date-time flag
         if self.date_time:
-            self._data += time.strftime("%Y%m%d%H%M%S", self.date_time)
+            header += time.strftime("%Y%m%d%H%M%S", self.date_time)
         else:
-            self._data += time.strftime("%Y%m%d%H%M%S", time.localtime())
-        self._data += "\x00\x00"
-        
-        self._data += struct.pack("<I", self.threads)
-        self._data += struct.pack("<I", len(thread_data)/2)
-        
-        if self.hoop_name == "A":
-            self._data += struct.pack("<I", 0)
-        elif self.hoop_name == "C":
-            self._data += struct.pack("<I", 1)
-        elif self.hoop_name == "B":
-            self._data += struct.pack("<I", 2)
-        elif self.hoop_name == "F":
-            self._data += struct.pack("<I", 3)
-        elif self.hoop_name == "D":
-            self._data += struct.pack("<I", 4)
-        else:
-            self._data += struct.pack("<I", 0)
+            header += time.strftime("%Y%m%d%H%M%S", time.localtime())
+        header += "\x00\x00"
+        
+        header += _header_counts.pack(self.threads, data_length/2,
+                                      hoop_codes.get(self.hoop_name, 0))
         
         if not self.rectangles:
         
@@ -149,31 +2406,61 @@ class Pattern:
         
         for x1, y1, x2, y2 in self.rectangles:
         
-            if len(self._data) < 0x74:
-            
-                self._data += struct.pack("<i", -x1)
-                self._data += struct.pack("<i", -y1)
-                self._data += struct.pack("<i", x2)
-                self._data += struct.pack("<i", y2)
+            if len(header) < 0x74:
+                header += _rectangle.pack(-x1, -y1, x2, y2)
         
         # Fill the gap between the end of the rectangle list and the colour
         # table.
-        while len(self._data) < 0x74:
-            self._data += struct.pack("<i", -1)
+        header += "\xff" * (0x74 - len(header))
+        
+        table = "<%ii" % self.threads
+        header += struct.pack(table, *self.colours[:self.threads])
+        header += struct.pack(table, *self.thread_types[:self.threads])
         
-        for i in range(self.threads):
-            self._data += struct.pack("<i", self.colours[i])
+        return header
+    
+    def _can_patch(self, path):
+    
+        """Returns True if the file with the given path already contains the
+        stitch data for the pattern, laid out as save() would write it."""
+        
+        if self._file != os.path.abspath(path):
+            return False
         
-        for i in range(self.threads):
-            self._data += struct.pack("<i", self.thread_types[i])
+        if self._coordinates is not None:
+            if self._coordinates.modified or len(self._coordinates) != self.threads:
+                return False
         
-        self._data += thread_data
+        return len(self.colours) == len(self.thread_types) == self.threads and \
+               self._start == 0x74 + (8 * self.threads)
+    
+    def _patch(self, path, header):
+    
+        """Writes the bytes in header that differ from those at the start of
+        the file with the given path over them, leaving the rest of the file
+        untouched."""
         
         try:
-            open(path, "w").write(self._data)
-            return True
+            f = open(path, "r+b")
+            try:
+                old = f.read(len(header))
+                
+                # Check that the file has not been changed by something else.
+                if len(old) != len(header) or old[:4] != header[:4] or \
+                   old[24:32] != header[24:32]:
+                    return False
+                
+                changed = [i for i in xrange(len(header)) if old[i] != chr(header[i])]
+                if changed:
+                    f.seek(changed[0])
+                    f.write(header[changed[0]:changed[-1] + 1])
+            finally:
+                f.close()
+        
         except IOError:
             return False
+        
+        return True
     
     def set_colour(self, index, code):
     
@@ -181,49 +2468,7 @@ class Pattern:
     
     def read_threads(self, data):
     
-        self.coordinates = []
-        x, y = 0, 0
-        
-        coordinates = []
-        first = True
-        i = 0
-        
-        while i < len(data):
-        
-            if data[i:i+2] == "\x80\x01":
-                # Starting a new thread. Record the coordinates already read
-                # and skip the next two bytes.
-                if coordinates:
-                    self.coordinates.append(coordinates)
-                coordinates = []
-                first = True
-                i += 4
-                continue
-            elif data[i:i+2] == "\x80\x02":
-                # Move command.
-                i += 2
-                command = "move"
-                first = True
-            elif data[i:i+2] == "\x80\x10":
-                # End of data.
-                if coordinates:
-                    self.coordinates.append(coordinates)
-                break
-            else:
-                command = "stitch"
-            
-            x += struct.unpack("<b", data[i])[0]
-            y += struct.unpack("<b", data[i+1])[0]
-            
-            if command == "move":
-                coordinates.append((command, x, y))
-            elif first:
-                coordinates.append(("move", x, y))
-                first = False
-            else:
-                coordinates.append((command, x, y))
-            
-            i += 2
+        self.coordinates = self._stitches.decode(data)
     
     def colour_for_thread(self, index):
     
@@ -236,44 +2481,475 @@ class Pattern:
         
         return colour
     
+    def thread(self, index):
+    
+        """Returns a Thread holding the coordinates of the thread with the
+        given index. If the pattern was loaded lazily and its coordinates
+        have not been used, only the stitch data for that thread is decoded,
+        after a scan of the control codes to find where the threads start."""
+        
+        if self._coordinates is not None:
+            return self._coordinates[index]
+        
+        if self._blocks is None:
+            self._blocks = scan_blocks(self._data, self._start)
+        
+        xs, ys, commands = decode_block(self._blocks[index])
+        return Thread(xs, ys, commands, 0, len(commands))
+    
+    def freeze(self):
+    
+        """Returns an immutable FrozenPattern holding a copy of the pattern,
+        completing it first if it is partial."""
+        
+        self.complete()
+        return FrozenPattern(self)
+    
+    def stats(self):
+    
+        """Returns a PatternStats describing the threads in the pattern,
+        completing it first if it is partial."""
+        
+        self.complete()
+        c = self.coordinates
+        return _pattern_stats(stitch_stats(c.x, c.y, c.commands, c.offsets))
+    
+    def fingerprint(self, invariant = False):
+    
+        """Returns the fingerprint of the pattern's stitches, completing it
+        first if it is partial; see the fingerprint function."""
+        
+        self.complete()
+        c = self.coordinates
+        xs, ys, commands, offsets = c.x, c.y, c.commands, c.offsets
+        
+        hasher = _Fingerprint(invariant)
+        for i, (start, end) in enumerate(izip(offsets, offsets[1:])):
+            hasher.add(i, xs[start:end], ys[start:end], commands[start:end])
+        
+        return hasher.hexdigest()
+    
     def write_threads(self):
     
-        thread_data = ""
+        return str(encode_stitches(self.coordinates))
+    
+    def bounding_rect(self):
+    
+        """Returns the smallest and largest coordinates in the pattern as a
+        tuple (x1, y1, x2, y2), or (0, 0, 0, 0) if it has no stitches."""
+        
+        return self.coordinates.extent() or (0, 0, 0, 0)
+    
+    def transform(self, a, b, c, d, e = 0, f = 0):
+    
+        """Moves each point (x, y) in the pattern to (a*x + b*y + e,
+        c*x + d*y + f), also transforming the rectangles in the header."""
         
-        cx, cy = 0, 0
-        first = True
+        self.complete()
+        matrix = (a, b, c, d, e, f)
+        self.coordinates.transform(*matrix)
+        self.rectangles = [_transform_rect(matrix, rect) for rect in self.rectangles]
+    
+    def translate(self, dx, dy):
+    
+        """Moves the pattern by dx and dy, rounded to whole units."""
         
-        for coordinates in self.coordinates:
+        self.transform(1, 0, 0, 1, _round(dx), _round(dy))
+    
+    def scale(self, sx, sy = None, centre = (0, 0)):
+    
+        """Scales the pattern by sx horizontally and sy vertically, or by sx
+        in both directions if sy is not given, about the given centre."""
         
-            if first:
-                first = False
-            else:
-                thread_data += "\x80\x01"
-                thread_data += "\x00\x00"
-            
-            for command, x, y in coordinates:
+        if sy is None:
+            sy = sx
+        
+        cx, cy = centre
+        self.transform(sx, 0, 0, sy, cx - sx * cx, cy - sy * cy)
+    
+    def rotate(self, angle, centre = (0, 0)):
+    
+        """Rotates the pattern anticlockwise by the given angle in degrees
+        about the given centre. Multiples of 90 degrees are exact."""
+        
+        quarters, remainder = divmod(angle, 90)
+        if remainder == 0:
+            cos, sin = ((1, 0), (0, 1), (-1, 0), (0, -1))[int(quarters) % 4]
+        else:
+            cos, sin = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+        
+        cx, cy = centre
+        self.transform(cos, -sin, sin, cos, cx - cos * cx + sin * cy,
+                                            cy - sin * cx - cos * cy)
+    
+    def mirror(self, horizontal = True, centre = (0, 0)):
+    
+        """Reflects the pattern from left to right if horizontal is True, or
+        from top to bottom otherwise, about the given centre."""
+        
+        cx, cy = centre
+        if horizontal:
+            self.transform(-1, 0, 0, 1, 2 * cx, 0)
+        else:
+            self.transform(1, 0, 0, -1, 0, 2 * cy)
+    
+    def fit_to_hoop(self, margin = 0, enlarge = False):
+    
+        """Centres the pattern at the origin, which is the centre of the hoop,
+        and scales it down if it does not fit inside the hoop with the given
+        margin in millimetres. If enlarge is True, smaller patterns are also
+        scaled up to fill the hoop."""
+        
+        self.complete()
+        x1, y1, x2, y2 = self.bounding_rect()
+        cx, cy = (x1 + x2) // 2, (y1 + y2) // 2
+        
+        factor = 1
+        if self.hoop_size:
+            width, height = [10 * (size - 2 * margin) for size in self.hoop_size]
+            factor = min(width / float(max(x2 - x1, 1)), height / float(max(y2 - y1, 1)))
+        
+        if factor >= 1 and not enlarge:
+            self.translate(-cx, -cy)
+        else:
+            self.transform(factor, 0, 0, factor, -factor * cx, -factor * cy)
+    
+    def __getstate__(self):
+    
+        """Returns a tuple describing the pattern for pickling, containing its
+        header information, the coordinates as a string of byte-sized deltas
+        where possible and the other arrays as strings. The file data and the
+        encoded form of the threads are not included, so pickles are small
+        and quick to create. A partial pattern is completed first."""
+        
+        self.complete()
+        stitches = self.coordinates
+        return (self.date_time, self.threads, self.hoop_size, self.hoop_name,
+                list(self.rectangles), list(self.colours), list(self.thread_types),
+                self._stitches is RunLengthStitches,
+                _pack_coordinates(stitches.x, stitches.y),
+                stitches.commands.tostring(), array("I", stitches.offsets).tostring())
+    
+    def __setstate__(self, state):
+    
+        (self.date_time, self.threads, self.hoop_size, self.hoop_name,
+         self.rectangles, self.colours, self.thread_types,
+         compact, coordinates, commands, offsets) = state
+        
+        self._file = None
+        if compact:
+            self._stitches = RunLengthStitches
+        else:
+            self._stitches = Stitches
+        
+        x, y = _unpack_coordinates(coordinates)
+        self.coordinates = self._stitches(x, y, array("B", commands), array("I", offsets))
+
+
+class FrozenPattern(Pattern):
+
+    """FrozenPattern
+    
+    An immutable snapshot of a Pattern, created by its freeze() method. The
+    header information is held in tuples and the stitches in a FrozenStitches
+    object, so that a snapshot can be shared between threads without locking
+    or copying. Attributes cannot be set and methods that would change the
+    pattern raise TypeError.
+    
+    The edit() method returns a new Pattern that shares the snapshot's stitch
+    data, only copying the threads that are replaced.
+    """
+    
+    def __init__(self, pattern):
+    
+        if isinstance(pattern.coordinates, FrozenStitches):
+            coordinates = pattern.coordinates
+        else:
+            coordinates = FrozenStitches(pattern.coordinates)
+        
+        for name, value in (
+            ("_file", None),
+            ("_stitches", Stitches),
+            ("_coordinates", coordinates),
+            ("date_time", pattern.date_time),
+            ("threads", pattern.threads),
+            ("hoop_size", pattern.hoop_size),
+            ("hoop_name", pattern.hoop_name),
+            ("rectangles", tuple(map(tuple, pattern.rectangles))),
+            ("colours", tuple(pattern.colours)),
+            ("thread_types", tuple(pattern.thread_types))):
             
-                if command == "move":
-                    thread_data += "\x80\x02"
-                
-                thread_data += struct.pack("<b", x - cx)
-                thread_data += struct.pack("<b", y - cy)
-                
-                cx = x
-                cy = y
+            object.__setattr__(self, name, value)
+    
+    def __setattr__(self, name, value):
+    
+        raise TypeError("FrozenPattern objects cannot be modified")
+    
+    def _read_only(self, *args, **kwargs):
+    
+        raise TypeError("FrozenPattern objects cannot be modified")
+    
+    load = set_colour = read_threads = transform = _read_only
+    
+    def freeze(self):
+    
+        return self
+    
+    def edit(self):
+    
+        """Returns a new Pattern with the same contents as the snapshot, which
+        reads the stitches of each thread from the snapshot until the thread
+        is replaced."""
         
-        thread_data += "\x80\x10"
-        return thread_data
+        pattern = Pattern()
+        pattern.date_time = self.date_time
+        pattern.threads = self.threads
+        pattern.hoop_size = self.hoop_size
+        pattern.hoop_name = self.hoop_name
+        pattern.rectangles = list(self.rectangles)
+        pattern.colours = list(self.colours)
+        pattern.thread_types = list(self.thread_types)
+        pattern.coordinates = CopyOnWriteStitches(self._coordinates)
+        return pattern
     
-    def bounding_rect(self):
+    def save(self, path, max_length = 127):
+    
+        """Saves the snapshot to the file with the given path, returning True
+        if successful or False otherwise."""
+        
+        return self.edit().save(path, max_length)
+    
+    def __reduce__(self):
     
-        xmin, xmax, ymin, ymax = [], [], [], []
-        for coordinates in self.coordinates:
-            x = map(lambda (command, x, y): x, coordinates)
-            y = map(lambda (command, x, y): y, coordinates)
-            xmin.append(min(x))
-            xmax.append(max(x))
-            ymin.append(min(y))
-            ymax.append(max(y))
+        return (FrozenPattern, (self.edit(),))
+
+
+def concatenate(patterns, offsets = None):
+
+    """Returns a new Pattern containing the threads of each of the given
+    patterns in turn, each moved by the corresponding (dx, dy) offset if a
+    list of offsets is given.
+    
+    The colour and thread type tables are joined and the hoop of the first
+    pattern is used. Threads keep the encoded form they were loaded or saved
+    with, so that when the new pattern is saved only the first coordinate
+    of each pattern is encoded again to join it to the one before. Partial
+    patterns are completed first."""
+    
+    for pattern in patterns:
+        pattern.complete()
+    
+    if offsets is None:
+        offsets = [(0, 0)] * len(patterns)
+    
+    x, y, commands = array("i"), array("i"), array("B")
+    thread_offsets = array("I", [0])
+    blocks = []
+    
+    result = Pattern()
+    if patterns:
+        result.hoop_name = patterns[0].hoop_name
+        result.hoop_size = patterns[0].hoop_size
+    
+    for pattern, (dx, dy) in izip(patterns, offsets):
+    
+        stitches = pattern.coordinates
+        part = Stitches(stitches.x, stitches.y, stitches.commands, stitches.offsets,
+                        list(stitches.blocks))
+        if dx or dy:
+            part.transform(1, 0, 0, 1, _round(dx), _round(dy))
+        
+        base = len(commands)
+        x.extend(part.x)
+        y.extend(part.y)
+        commands.extend(part.commands)
+        thread_offsets.extend(array("I", [base + i for i in part.offsets[1:]]))
+        blocks.extend(part.blocks)
+        
+        result.colours.extend(pattern.colours[:len(part)])
+        result.thread_types.extend(pattern.thread_types[:len(part)])
+    
+    result.coordinates = Stitches(x, y, commands, thread_offsets, blocks)
+    result.threads = len(result.coordinates)
+    return result
+
+
+class SharedPattern:
+
+    """SharedPattern
+    
+    A handle to a copy of a pattern's stitch arrays held in a file that other
+    processes can map into memory, created by share(). Handles only contain
+    the file name and the header information, so they are quick to pickle
+    and send to worker processes, which call attach() to obtain a
+    FrozenPattern that reads its stitches from the mapped file instead of
+    decoding them or receiving a copy of them.
+    
+    The process that created the handle should call unlink() once the other
+    processes have attached to it or have finished with it.
+    """
+    
+    def __init__(self, path, stitches, threads, header, extents):
+    
+        self.path = path
+        self.stitches = stitches
+        self.threads = threads
+        self.header = header
+        self.extents = extents
+    
+    def attach(self):
+    
+        """Maps the file into memory, returning a FrozenPattern that reads
+        its stitches from it."""
+        
+        f = open(self.path, "rb")
+        try:
+            data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
         
-        return (min(xmin), min(ymin), max(xmax), max(ymax))
+        n = self.stitches
+        offsets = array("I", data[9 * n:9 * n + 4 * (self.threads + 1)])
+        stitches = FrozenStitches._from_buffers(
+            buffer(data, 0, 4 * n), buffer(data, 4 * n, 4 * n),
+            buffer(data, 8 * n, n), offsets, self.extents)
+        
+        pattern = Pattern()
+        (pattern.date_time, pattern.threads, pattern.hoop_size, pattern.hoop_name,
+         pattern.rectangles, pattern.colours, pattern.thread_types) = self.header
+        pattern.coordinates = stitches
+        return FrozenPattern(pattern)
+    
+    def unlink(self):
+    
+        """Removes the file. Processes that have already attached to it can
+        continue to use it on systems that allow open files to be removed."""
+        
+        os.remove(self.path)
+
+
+def share(pattern, directory = None):
+
+    """Copies the stitch arrays of the pattern to a new file in the given
+    directory and returns a SharedPattern handle for it. If no directory is
+    given, the file is created in /dev/shm if it exists, so that it is held
+    in shared memory, or in the usual temporary directory otherwise. A
+    partial pattern is completed first."""
+    
+    pattern.complete()
+    
+    if directory is None and os.path.isdir("/dev/shm"):
+        directory = "/dev/shm"
+    
+    stitches = pattern.coordinates
+    fd, path = tempfile.mkstemp(prefix = "jef-", suffix = ".shm", dir = directory)
+    f = os.fdopen(fd, "wb")
+    try:
+        f.write(stitches.x.tostring())
+        f.write(stitches.y.tostring())
+        f.write(stitches.commands.tostring())
+        f.write(array("I", stitches.offsets).tostring())
+    finally:
+        f.close()
+    
+    header = (pattern.date_time, pattern.threads, pattern.hoop_size,
+              pattern.hoop_name, list(pattern.rectangles), list(pattern.colours),
+              list(pattern.thread_types))
+    extents = map(stitches.thread_extent, xrange(len(stitches)))
+    
+    return SharedPattern(path, stitches.stitch_count(), len(stitches), header, extents)
+
+
+LoadResult = namedtuple("LoadResult", "path pattern error")
+
+
+def _load(path):
+
+    """Returns a LoadResult for the file with the given path, containing
+    either the pattern loaded from it or a description of the error that
+    occurred."""
+    
+    try:
+        return LoadResult(path, Pattern(path), None)
+    except Exception:
+        return LoadResult(path, None, traceback.format_exc())
+
+
+def _call_chunk(function, paths):
+
+    return map(function, paths)
+
+
+def process_many(function, paths, workers = None, ordered = True, chunksize = 4):
+
+    """Calls function with each of the given paths using a pool of worker
+    processes, yielding the results.
+    
+    The function must be defined at the top level of a module so that it can
+    be passed to the workers. Exceptions raised by it, or raised when its
+    results are passed back from the workers, are raised again here when the
+    results of its chunk would be yielded. The number of workers defaults to
+    the number of processors; if it is 1, the function is called in this
+    process. If ordered is True, the results are yielded in the same order
+    as the paths; otherwise they are yielded as they become available.
+    
+    Only 2 * workers chunks of chunksize paths are given to the workers at a
+    time so that unread results do not accumulate in memory. If iteration
+    stops early, the pool is shut down once the chunks already given to the
+    workers have been processed, so closing the generator can take as long
+    as processing that many paths."""
+    
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    
+    if workers <= 1:
+        for result in imap(function, paths):
+            yield result
+        return
+    
+    paths = iter(paths)
+    pool = multiprocessing.Pool(workers)
+    pending = deque()
+    
+    try:
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = list(islice(paths, chunksize))
+                if not chunk:
+                    break
+                pending.append(pool.apply_async(_call_chunk, (function, chunk)))
+            
+            if not pending:
+                break
+            elif ordered:
+                results = pending.popleft().get()
+            else:
+                # Failed chunks never run callbacks in Python 2, so poll the
+                # pending chunks for one that has finished either way.
+                while not any(result.ready() for result in pending):
+                    pending[0].wait(0.01)
+                finished = [result for result in pending if result.ready()][0]
+                pending.remove(finished)
+                results = finished.get()
+            
+            for result in results:
+                yield result
+    
+    finally:
+        # Pool.terminate() can deadlock in Python 2 while a worker is
+        # sending back a large result, so let the chunks in progress finish.
+        pool.close()
+        pool.join()
+
+
+def load_many(paths, workers = None, ordered = True, chunksize = 4):
+
+    """Loads the patterns in the files with the given paths using a pool of
+    worker processes, yielding a LoadResult for each of them; see
+    process_many() for the meaning of the arguments.
+    
+    Files that cannot be loaded produce results with a pattern of None and an
+    error containing the traceback. Patterns are pickled in a compact form
+    when they are returned from the workers; see Pattern.__getstate__()."""
+    
+    return process_many(_load, paths, workers, ordered, chunksize)
@@ -20,6 +20,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os, sys
+from itertools import izip
 from PyQt4.QtCore import QRect, Qt
 from PyQt4.QtGui import *
 
@@ -27,27 +28,24 @@ import jef
 
 class Convertor:
 
-    def __init__(self, path, stitches_only = False):
+    def __init__(self, path, stitches_only = False, tolerance = 0):
     
         self.jef = jef.Pattern(path)
         self.stitches_only = stitches_only
         self.rect = QRect()
+        
+        # The distance in pattern units by which stitches can be moved when
+        # simplifying the threads for drawing.
+        self.tolerance = tolerance
     
     def bounding_rect(self):
     
         if not self.rect.isNull():
             return self.rect
         
-        x, y = [], []
-        for coordinates in self.jef.coordinates:
-            i = map(lambda (op, i, j): i, coordinates)
-            j = map(lambda (op, i, j): j, coordinates)
-            x.append(min(i))
-            x.append(max(i))
-            y.append(min(j))
-            y.append(max(j))
-        
-        return QRect(min(x), -max(y), max(x) - min(x), max(y) - min(y))
+        x1, y1, x2, y2 = self.jef.bounding_rect()
+        self.rect = QRect(x1, -y2, x2 - x1, y2 - y1)
+        return self.rect
     
     def show(self, painter):
     
@@ -58,23 +56,33 @@ class Convertor:
         for i in range(self.jef.threads):
         
             colour = QColor(*self.jef.colour_for_thread(i))
-            coordinates = self.jef.coordinates[i]
+            thread = self.jef.coordinates[i]
+            xs, ys = thread.x, thread.y
             
             if not self.stitches_only:
                 pen = QPen(QColor(200, 200, 200))
                 painter.setPen(pen)
                 
-                for op, x, y in coordinates:
+                for x, y in izip(xs, ys):
                     painter.drawEllipse(x - 2, -y - 2, 4, 4)
             
+            # Only draw the lines of the simplified thread if it has fewer
+            # points than the original.
+            if self.tolerance:
+                simplified = thread.simplify(self.tolerance)
+                if len(simplified) < len(thread):
+                    thread = simplified
+            
+            xs, ys, commands = thread.x, thread.y, thread.commands
+            
             pen = QPen(colour)
             painter.setPen(pen)
             
             mx, my = 0, 0
-            for op, x, y in coordinates:
-                if op == "move":
+            for op, x, y in izip(commands, xs, ys):
+                if op == jef.MOVE:
                     mx, my = x, y
-                elif op == "stitch":
+                elif op == jef.STITCH:
                     painter.drawLine(mx, -my, x, -y)
                     mx, my = x, y
             
@@ -139,6 +147,11 @@ if __name__ == "__main__":
     convertor = Convertor(jef_file, stitches_only)
     rect = convertor.bounding_rect()
     
+    # Leave out stitches that repeat lines already drawn, or continue them in
+    # a straight line, to within half a pixel in the scaled image.
+    scale = max(rect.width() / float(width), rect.height() / float(height))
+    convertor.tolerance = scale / 2
+    
     image = QImage(rect.width(), rect.height(), QImage.Format_ARGB32)
     image.fill(background_colour)
     
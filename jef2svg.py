@@ -20,6 +20,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os, sys
+from itertools import izip
 from PyQt4.QtCore import QRect, QT_VERSION
 from PyQt4.QtGui import *
 from PyQt4.QtSvg import QSvgGenerator
@@ -35,12 +36,8 @@ class Convertor:
     
     def bounding_rect(self):
     
-        x, y = [], []
-        for coordinates in self.jef.coordinates:
-            x.extend(map(lambda (op, i, j): i, coordinates))
-            y.extend(map(lambda (op, i, j): j, coordinates))
-        
-        return QRect(min(x), -max(y), max(x) - min(x), max(y) - min(y))
+        x1, y1, x2, y2 = self.jef.bounding_rect()
+        return QRect(x1, -y2, x2 - x1, y2 - y1)
     
     def show(self, painter):
     
@@ -48,23 +45,24 @@ class Convertor:
         for i in range(self.jef.threads):
         
             colour = QColor(*self.jef.colour_for_thread(i))
-            coordinates = self.jef.coordinates[i]
+            thread = self.jef.coordinates[i]
+            xs, ys, commands = thread.x, thread.y, thread.commands
             
             if not self.stitches_only:
                 pen = QPen(QColor(200, 200, 200))
                 painter.setPen(pen)
                 
-                for op, x, y in coordinates:
+                for x, y in izip(xs, ys):
                     painter.drawEllipse(x - 2, -y - 2, 4, 4)
             
             pen = QPen(colour)
             painter.setPen(pen)
             
             path = QPainterPath()
-            for op, x, y in coordinates:
-                if op == "move":
+            for op, x, y in izip(commands, xs, ys):
+                if op == jef.MOVE:
                     path.moveTo(x, -y)
-                elif op == "stitch":
+                elif op == jef.STITCH:
                     path.lineTo(x, -y)
             
             if path.elementCount() > 0:
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""
+jefestimate.py - Estimates the time taken to sew the designs in JEF files.
+
+Copyright (C) 2026 agent <agent@local>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import bisect, sys
+from collections import namedtuple
+from itertools import izip
+
+import jef
+
+# Estimated times in seconds for each thread and for the whole pattern,
+# including colour changes and hooping.
+Estimate = namedtuple("Estimate", "threads total")
+
+
+class Machine:
+
+    """Machine
+    
+    Describes how quickly a machine sews. The speeds list contains
+    (length, stitches per minute) pairs in order of increasing stitch length
+    in millimetres, each giving the speed for stitches up to that length;
+    longer stitches are sewn at the last speed. The remaining times are in
+    seconds: jump_time for each jump (including any trim), colour_change_time
+    for each change of thread and hoop_time for hooping each design.
+    """
+    
+    def __init__(self, speeds = None, jump_time = 1.0, colour_change_time = 30.0,
+                       hoop_time = 60.0):
+        
+        if speeds is None:
+            speeds = [(3.0, 800), (5.0, 700), (7.0, 600), (10.0, 500), (12.7, 400)]
+        
+        # Store the lengths in tenths of a millimetre to match the stitches.
+        self.lengths = [10 * length for length, rate in speeds]
+        self.seconds = [60.0 / rate for length, rate in speeds]
+        self.jump_time = jump_time
+        self.colour_change_time = colour_change_time
+        self.hoop_time = hoop_time
+
+
+def thread_times(xs, ys, commands, offsets, machine, x = 0, y = 0, command = jef.MOVE):
+
+    """Returns a list containing the time in seconds taken to sew each thread
+    in the given columns of coordinates and commands, where offsets holds the
+    index of the first stitch in each thread followed by the total number of
+    stitches. The position (x, y) and command precede the first stitch, as
+    for jef.stitch_stats()."""
+    
+    lengths = jef.stitch_lengths(xs, ys, commands, x, y)
+    jumps = jef.count_jumps(commands, offsets, command)
+    
+    if jef.numpy and commands:
+        numpy = jef.numpy
+        index = numpy.searchsorted(machine.lengths, lengths)
+        index = numpy.minimum(index, len(machine.seconds) - 1)
+        times = numpy.asarray(machine.seconds)[index]
+        times[numpy.frombuffer(commands, numpy.uint8) != jef.STITCH] = 0
+        totals = numpy.concatenate(([0.0], numpy.cumsum(times)))
+        ends = numpy.asarray(offsets, numpy.intp)
+        stitch_times = totals[ends[1:]] - totals[ends[:-1]]
+    else:
+        last = len(machine.seconds) - 1
+        times = [machine.seconds[min(bisect.bisect_left(machine.lengths, length), last)]
+                 if c == jef.STITCH else 0.0
+                 for length, c in izip(lengths, commands)]
+        stitch_times = [sum(times[start:end])
+                        for start, end in izip(offsets, offsets[1:])]
+    
+    return [float(t) + n * machine.jump_time for t, n in izip(stitch_times, jumps)]
+
+
+def _estimate(threads, machine):
+
+    total = sum(threads, 0.0) + machine.hoop_time
+    total += max(len(threads) - 1, 0) * machine.colour_change_time
+    return Estimate(threads, total)
+
+
+def estimate(pattern, machine = None):
+
+    """Returns an Estimate of the time taken to sew the given jef.Pattern on
+    the given machine, or on a default Machine if none is given."""
+    
+    machine = machine or Machine()
+    c = pattern.coordinates
+    return _estimate(thread_times(c.x, c.y, c.commands, c.offsets, machine), machine)
+
+
+def estimate_stream(f, machine = None, block_size = 65536):
+
+    """Returns an Estimate of the time taken to sew the design in the JEF file
+    read from the file object f, decoding its stitch data a block at a time
+    with a jef.StitchReader."""
+    
+    machine = machine or Machine()
+    threads = []
+    x, y, command = 0, 0, jef.MOVE
+    
+    reader = jef.StitchReader(f, block_size)
+    for thread, xs, ys, commands in reader.chunks(block_size):
+    
+        if thread == len(threads):
+            threads.append(0.0)
+            command = jef.MOVE
+        
+        threads[thread] += thread_times(xs, ys, commands, [0, len(commands)],
+                                        machine, x, y, command)[0]
+        x, y, command = xs[-1], ys[-1], commands[-1]
+    
+    return _estimate(threads, machine)
+
+
+def format_time(seconds):
+
+    seconds = int(round(seconds))
+    return "%i:%02i:%02i" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: %s <JEF file> ...\n" % sys.argv[0])
+        sys.exit(1)
+    
+    machine = Machine()
+    total = 0.0
+    
+    for path in sys.argv[1:]:
+        f = open(path, "rb")
+        try:
+            result = estimate_stream(f, machine)
+        finally:
+            f.close()
+        
+        print format_time(result.total), path
+        total += result.total
+    
+    if len(sys.argv) > 2:
+        print format_time(total), "total"
+    
+    sys.exit()
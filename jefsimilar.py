@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+"""
+jefsimilar.py - Finds JEF files containing similar designs.
+
+Copyright (C) 2026 agent <agent@local>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import operator, os, random, struct, sys, traceback
+from collections import namedtuple
+
+import jef
+
+SignatureResult = namedtuple("SignatureResult", "path signature error")
+
+# Random hyperplanes used to reduce density grids to signatures, keyed by
+# (cells, bits, whether they are held in a NumPy array). They are generated
+# from a fixed seed so that signatures computed in different processes and
+# sessions can be compared.
+_planes = {}
+
+
+def density_grid(pattern, size = 16):
+
+    """Returns the total length of the stitches ending in each cell of a
+    size by size grid covering the pattern's bounding rectangle, as a list of
+    size * size values (or a NumPy array if NumPy is available) ordered by
+    row and scaled so that they add up to 1. Moves are not counted.
+    
+    Since the grid is stretched to fit the pattern, resized copies of a
+    design have nearly the same grid."""
+    
+    numpy = jef.numpy
+    c = pattern.coordinates
+    cells = size * size
+    x1, y1, x2, y2 = pattern.bounding_rect()
+    width, height = x2 - x1 + 1, y2 - y1 + 1
+    lengths = jef.stitch_lengths(c.x, c.y, c.commands)
+    
+    if numpy:
+        if not len(lengths):
+            return numpy.zeros(cells)
+        xs = numpy.frombuffer(c.x, numpy.int32)
+        ys = numpy.frombuffer(c.y, numpy.int32)
+        columns = (xs - x1) * size // width
+        rows = (ys - y1) * size // height
+        grid = numpy.bincount(rows * size + columns, lengths, cells)
+        total = grid.sum()
+        return grid / total if total else grid
+    
+    grid = [0.0] * cells
+    for x, y, length in zip(c.x, c.y, lengths):
+        if length:
+            grid[(y - y1) * size // height * size + (x - x1) * size // width] += length
+    
+    total = sum(grid)
+    if total:
+        grid = [value / total for value in grid]
+    
+    return grid
+
+
+def _hyperplanes(cells, bits):
+
+    key = (cells, bits, jef.numpy is not None)
+    if key not in _planes:
+        generator = random.Random(cells * 1000 + bits)
+        planes = [[generator.gauss(0.0, 1.0) for i in xrange(cells)]
+                  for j in xrange(bits)]
+        if jef.numpy:
+            planes = jef.numpy.array(planes)
+        _planes[key] = planes
+    
+    return _planes[key]
+
+
+def signature(pattern, size = 16, bits = 64):
+
+    """Returns an integer with the given number of bits summarising the
+    shape of the pattern, computed from its density grid (see density_grid)
+    so that similar designs have signatures differing in only a few bits.
+    
+    Each bit records which side of a random hyperplane the grid lies on,
+    after subtracting the mean density from each cell, so the number of bits
+    that differ between two signatures estimates the angle between the
+    grids."""
+    
+    cells = size * size
+    grid = density_grid(pattern, size)
+    planes = _hyperplanes(cells, bits)
+    mean = 1.0 / cells
+    
+    if jef.numpy:
+        projections = jef.numpy.dot(planes, grid - mean)
+    else:
+        centred = [value - mean for value in grid]
+        projections = [sum(map(operator.mul, plane, centred)) for plane in planes]
+    
+    value = 0
+    for i, projection in enumerate(projections):
+        if projection > 0:
+            value |= 1 << i
+    
+    return value
+
+
+def distance(a, b):
+
+    """Returns the number of bits that differ between the signatures a and b."""
+    
+    return bin(a ^ b).count("1")
+
+
+def _signature(path):
+
+    try:
+        return SignatureResult(path, signature(jef.Pattern(path)), None)
+    except Exception:
+        return SignatureResult(path, None, traceback.format_exc())
+
+
+def signatures(paths, workers = None, ordered = True, chunksize = 16):
+
+    """Computes the signatures of the designs in the files with the given
+    paths using a pool of worker processes, yielding a SignatureResult for
+    each of them; see jef.process_many() for the meaning of the arguments.
+    Files that cannot be loaded produce results with a signature of None and
+    an error containing the traceback."""
+    
+    return jef.process_many(_signature, paths, workers, ordered, chunksize)
+
+
+class SignatureIndex:
+
+    """SignatureIndex
+    
+    Holds the signatures of a collection of designs, each identified by a
+    key such as a file name, and finds the ones close to a given signature
+    without comparing it with all of them. Each signature is divided into
+    the given number of bands of bits and the keys are filed under the value
+    of each band; only the designs sharing at least one band with the
+    signature are compared with it.
+    """
+    
+    magic = "JSIG"
+    
+    def __init__(self, bits = 64, bands = 8):
+    
+        if bits > 64 or bits % bands:
+            raise ValueError("Signatures must have at most 64 bits, divided "
+                             "equally between the bands.")
+        
+        self.bits = bits
+        self.bands = bands
+        self.width = bits // bands
+        self.keys = []
+        self.signatures = []
+        self.indices = {}
+        self.buckets = [{} for i in range(bands)]
+    
+    def __len__(self):
+    
+        return len(self.keys)
+    
+    def _bands(self, signature):
+    
+        mask = (1 << self.width) - 1
+        return [(signature >> (i * self.width)) & mask for i in range(self.bands)]
+    
+    def add(self, key, signature):
+    
+        """Adds the signature for the design with the given key, replacing any
+        that it already has."""
+        
+        if key in self.indices:
+            i = self.indices[key]
+            for bucket, band in zip(self.buckets, self._bands(self.signatures[i])):
+                bucket[band].remove(i)
+            self.signatures[i] = signature
+        else:
+            i = len(self.keys)
+            self.indices[key] = i
+            self.keys.append(key)
+            self.signatures.append(signature)
+        
+        for bucket, band in zip(self.buckets, self._bands(signature)):
+            bucket.setdefault(band, []).append(i)
+    
+    def query(self, signature, max_distance = None, limit = None):
+    
+        """Returns a list of (distance, key) tuples for the designs whose
+        signatures share a band with the given one, nearest first, leaving out
+        those further away than max_distance bits and any after the first
+        limit designs."""
+        
+        candidates = set()
+        for bucket, band in zip(self.buckets, self._bands(signature)):
+            candidates.update(bucket.get(band, ()))
+        
+        results = []
+        for i in candidates:
+            d = distance(signature, self.signatures[i])
+            if max_distance is None or d <= max_distance:
+                results.append((d, self.keys[i]))
+        
+        results.sort()
+        return results[:limit]
+    
+    def similar(self, key, max_distance = None, limit = None):
+    
+        """Returns a list of (distance, key) tuples for the designs similar to
+        the one with the given key, leaving out the design itself; see
+        query()."""
+        
+        results = self.query(self.signatures[self.indices[key]], max_distance)
+        return [result for result in results if result[1] != key][:limit]
+    
+    def save(self, path):
+    
+        """Writes the index to the file with the given path. The signatures
+        are stored in eight bytes each, followed by the keys."""
+        
+        keys = "\0".join(key.encode("utf8") if isinstance(key, unicode) else key
+                         for key in self.keys)
+        f = open(path, "wb")
+        try:
+            f.write(struct.pack("<4sIII", self.magic, self.bits, self.bands,
+                                len(self.keys)))
+            f.write(struct.pack("<%iQ" % len(self.signatures), *self.signatures))
+            f.write(keys)
+        finally:
+            f.close()
+
+
+def load_index(path):
+
+    """Returns the SignatureIndex stored in the file with the given path."""
+    
+    f = open(path, "rb")
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    
+    magic, bits, bands, n = struct.unpack("<4sIII", data[:16])
+    if magic != SignatureIndex.magic:
+        raise ValueError("Not a signature index: %s" % path)
+    
+    index = SignatureIndex(bits, bands)
+    values = struct.unpack("<%iQ" % n, data[16:16 + 8 * n])
+    keys = data[16 + 8 * n:].split("\0") if n else []
+    
+    for key, value in zip(keys, values):
+        index.add(key, value)
+    
+    return index
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 4 or sys.argv[1] not in ("add", "query"):
+        sys.stderr.write("Usage: %s add <index file> <JEF file> ...\n"
+                         "       %s query <index file> <JEF file> [<distance>]\n"
+                         % (sys.argv[0], sys.argv[0]))
+        sys.exit(1)
+    
+    command, index_path = sys.argv[1:3]
+    
+    if os.path.exists(index_path):
+        index = load_index(index_path)
+    else:
+        index = SignatureIndex()
+    
+    if command == "add":
+    
+        for result in signatures(sys.argv[3:], ordered = False):
+            if result.error:
+                sys.stderr.write("Failed to read %s\n" % result.path)
+            else:
+                index.add(result.path, result.signature)
+        
+        index.save(index_path)
+    
+    else:
+        path = sys.argv[3]
+        if len(sys.argv) > 4:
+            max_distance = int(sys.argv[4])
+        else:
+            max_distance = index.bits // 4
+        
+        value = signature(jef.Pattern(path))
+        for d, key in index.query(value, max_distance):
+            if key != path:
+                print d, key
+    
+    sys.exit()
@@ -20,6 +20,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os, sys
+from itertools import izip
 from PyQt4.QtCore import QLine, QObject, QPoint, QRect, QSize, Qt, QVariant, \
                          SIGNAL, SLOT
 from PyQt4.QtGui import *
@@ -68,26 +69,23 @@ class Renderer:
         
         for i in range(len(self.pattern.coordinates)):
         
-            coordinates = self.pattern.coordinates[i]
+            thread = self.pattern.coordinates[i]
             colour_item = self.colourModel.item(i)
             
             lines = []
-            xb, yb = [], []
+            xb, yb = thread.x, thread.y
             mx, my = 0, 0
             
-            for op, x, y in coordinates:
-                xb.append(x)
-                yb.append(y)
-                if op == "move":
+            for op, x, y in izip(thread.commands, xb, yb):
+                if op == jef.MOVE:
                     mx, my = x, y
-                elif op == "stitch":
+                elif op == jef.STITCH:
                     line = QLine(mx, -my, x, -y)
                     lines.append(line)
                     mx, my = x, y
             
-            xb = [min(xb), max(xb)]
-            yb = [min(yb), max(yb)]
-            rect = QRect(min(xb), -max(yb), max(xb) - min(xb), max(yb) - min(yb))
+            x1, y1, x2, y2 = self.pattern.coordinates.thread_extent(i)
+            rect = QRect(x1, -y2, x2 - x1, y2 - y1)
             self.rect = self.rect.united(rect)
             
             zone = Zone(rect, colour_item)
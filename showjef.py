@@ -20,6 +20,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import sys
+from itertools import izip
 from PyQt4.QtCore import Qt
 from PyQt4.QtGui import *
 
@@ -60,16 +61,16 @@ class Convertor:
         self.move_pen = QPen()
         self.move_pen.setStyle(Qt.DotLine)
     
-    def show_coords(self, coords, pen, scene):
+    def show_coords(self, thread, pen, scene):
     
         first = True
         mx, my = 0, 0
-        for op, x, y in coords:
+        for op, x, y in izip(thread.commands, thread.x, thread.y):
         
             if not self.stitches_only:
                 scene.addEllipse(x - 2, -y - 2, 4, 4, QPen(QColor(200,200,200)))
             
-            if op == "stitch":
+            if op == jef.STITCH:
                 scene.addLine(mx, -my, x, -y, pen)
             elif self.show_jumps:
                 if first:
@@ -87,8 +88,8 @@ class Convertor:
         
             colour = QColor(*self.jef.colour_for_thread(i))
             pen = QPen(colour)
-            coordinates = self.jef.coordinates[i]
-            self.show_coords(coordinates, pen, scene)
+            thread = self.jef.coordinates[i]
+            self.show_coords(thread, pen, scene)
             i += 1
 
 
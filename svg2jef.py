@@ -221,46 +221,10 @@ if __name__ == "__main__":
     
     # Translate the pattern to be centred about the origin.
     x1, y1, x2, y2 = pattern.bounding_rect()
-    dx = -(x2 - x1)/2 - x1
-    dy = -(y2 - y1)/2 - y1
+    pattern.translate(-(x2 - x1)/2 - x1, -(y2 - y1)/2 - y1)
     
-    cx, cy = 0, 0
-    
-    for coordinates in pattern.coordinates:
-    
-        i = 0
-        while i < len(coordinates):
-        
-            command, x, y = coordinates[i]
-            x = int(x + dx)
-            y = int(y + dy)
-            
-            # If one or both dimensions are greater than the maximum stitch
-            # length then split the line into pieces.
-            d = max(abs(x - cx), abs(y - cy))
-            n = (d / max_stitch_length)
-            
-            if n > 1:
-            
-                xs = max(-max_stitch_length, min(float(x - cx)/n, max_stitch_length))
-                ys = max(-max_stitch_length, min(float(y - cy)/n, max_stitch_length))
-                
-                # Insert moves/stitches at intermediate positions.
-                j = 1
-                while j < n:
-                    px = cx + (j * xs)
-                    py = cy + (j * ys)
-                    coordinates.insert(i, (command, int(px), int(py)))
-                    i += 1
-                    j += 1
-                
-                cx, cy = px, py
-            
-            # Update the original coordinate.
-            coordinates[i] = (command, x, y)
-            cx, cy = x, y
-            i += 1
-    
-    pattern.save(jef_file)
+    # Moves and stitches that are longer than the maximum stitch length are
+    # split into pieces when the pattern is saved.
+    pattern.save(jef_file, max_stitch_length)
     
     sys.exit()